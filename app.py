@@ -2,18 +2,46 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+_BOOT = time.perf_counter()  # STARTUP timings count from here
 import tempfile
 import shutil
 import glob
 import threading
 import uuid
+import signal
+import socket
+import subprocess
 import re
 import math
+import bisect
+import heapq
+import copy
+import hashlib
+import gzip
+from collections import OrderedDict, deque, namedtuple
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, request, jsonify, render_template_string, abort, send_file
+import io
+import json
+import zipfile
+import mimetypes
+import sqlite3
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from flask import Flask, request, jsonify, render_template_string, abort, Response
 from shutil import which
-from yt_dlp import YoutubeDL
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.middleware.proxy_fix import ProxyFix
+from urllib.parse import quote, urlsplit
+import urllib.error
+import urllib.request
+try:
+    import brotli  # optional: br variants of the static frontend
+except ImportError:
+    brotli = None
+# yt-dlp is imported on first use (see _yt_dlp): it dominates cold start
+
+STARTUP = {"imports": round(time.perf_counter() - _BOOT, 3)}  # seconds from boot to each startup step
 
 # ---------- CONFIG ----------
 DEBUG_LOG = os.environ.get("DEBUG_LOG", "") not in ("", "0", "false", "False")
@@ -21,10 +49,63 @@ PORT = int(os.environ.get("PORT", 5000))
 APP_PREFIX = os.environ.get("APP_PREFIX", "Hyper_Downloader")
 JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 60 * 60))  # 1 hour default
 DOWNLOAD_KEEP_SECONDS = int(os.environ.get("DOWNLOAD_KEEP_SECONDS", 60))  # 60s after fetch
-CLEANUP_INTERVAL = int(os.environ.get("CLEANUP_INTERVAL", 60 * 10))
+CLEANUP_INTERVAL = int(os.environ.get("CLEANUP_INTERVAL", 60 * 10))  # backstop full scan; expiries are scheduled
+MAX_JOBS = int(os.environ.get("MAX_JOBS", 10000))  # registered jobs; oldest finished ones are dropped beyond it
+ERROR_MAX_CHARS = int(os.environ.get("ERROR_MAX_CHARS", 200))  # job error messages are cut to this length
+CLEANUP_THREADS = int(os.environ.get("CLEANUP_THREADS", 2))  # threads deleting expired job dirs
 MAX_CONCURRENT = int(os.environ.get("MAX_CONCURRENT", 3))  # limit concurrent downloads
+AUDIO_RESERVED_SLOTS = int(os.environ.get("AUDIO_RESERVED_SLOTS", 1))  # workers that only run audio jobs
+MAX_QUEUED = int(os.environ.get("MAX_QUEUED", 100))  # queued jobs before /start answers 429
+MAX_QUEUED_PER_CLIENT = int(os.environ.get("MAX_QUEUED_PER_CLIENT", 5))
+STREAM_START_TIMEOUT = int(os.environ.get("STREAM_START_TIMEOUT", 120))  # /fetch wait for a streamable file
+RESUME_KEEP_SECONDS = int(os.environ.get("RESUME_KEEP_SECONDS", 15 * 60))  # retention after a ranged (resumable) fetch
+BATCH_PARALLEL = int(os.environ.get("BATCH_PARALLEL", 2))  # items of one batch downloading at once
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 50))
+ABANDON_SECONDS = int(os.environ.get("ABANDON_SECONDS", 120))  # cancel jobs nobody polled for this long (0 = never)
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", 0.5))  # min seconds between progress events
+PROGRESS_WAIT_SECONDS = int(os.environ.get("PROGRESS_WAIT_SECONDS", 25))  # long-poll / SSE keepalive timeout
+JOB_STORE_BACKEND = os.environ.get("JOB_STORE", "memory")  # "memory" or "sqlite" (shared by gunicorn workers)
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "hyper_jobs.db"))
+JOB_STORE_FLUSH_INTERVAL = float(os.environ.get("JOB_STORE_FLUSH_INTERVAL", 1.0))  # batched progress writes
+INFO_CACHE_TTL = int(os.environ.get("INFO_CACHE_TTL", 300))  # seconds a cached /info result stays valid
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", 256))  # max cached videos (LRU)
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "hyper_artifacts"))
+ARTIFACT_CACHE_BYTES = int(os.environ.get("ARTIFACT_CACHE_BYTES", 2 * 1024 ** 3))  # shared result cache size
+ARTIFACT_TTL_SECONDS = int(os.environ.get("ARTIFACT_TTL_SECONDS", JOB_TTL_SECONDS))
+WORK_DIR = os.environ.get("WORK_DIR", tempfile.gettempdir())  # volume for per-job temp dirs
+AUDIO_WORK_DIR = os.environ.get("AUDIO_WORK_DIR", WORK_DIR)  # e.g. a tmpfs (/dev/shm) for short audio jobs
+STORAGE_QUOTA_BYTES = int(os.environ.get("STORAGE_QUOTA_BYTES", 0))  # running jobs + result cache (0 = no quota)
+STORAGE_MIN_FREE_BYTES = int(os.environ.get("STORAGE_MIN_FREE_BYTES", 512 * 1024 ** 2))  # free space kept per volume
+STORAGE_WAIT_SECONDS = int(os.environ.get("STORAGE_WAIT_SECONDS", 120))  # wait for space before failing a job
+STORAGE_DEFAULT_ESTIMATE = int(os.environ.get("STORAGE_DEFAULT_ESTIMATE", 256 * 1024 ** 2))  # size unknown
+TRANSCODE_SLOTS = int(os.environ.get("TRANSCODE_SLOTS", os.cpu_count() or 2))  # concurrent ffmpeg postprocessing runs
+JOB_CONNECTIONS = int(os.environ.get("JOB_CONNECTIONS", 1))  # upstream connections per download (>1: multi-connection mode)
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", MAX_CONCURRENT * 4))  # shared by all running downloads
+EXTERNAL_DOWNLOADER = os.environ.get("EXTERNAL_DOWNLOADER", "aria2c")  # for plain HTTP formats if on PATH ("" = never)
+INGRESS_LIMIT_BYTES = int(os.environ.get("INGRESS_LIMIT_BYTES", 0))  # bytes/s for all downloads, split among running jobs (0 = no cap)
+EGRESS_CLIENT_LIMIT_BYTES = int(os.environ.get("EGRESS_CLIENT_LIMIT_BYTES", 0))  # bytes/s per client over its /fetch transfers (0 = no cap)
+INFO_POOL_SIZE = int(os.environ.get("INFO_POOL_SIZE", 2))  # idle pre-initialized YoutubeDL instances kept for /info
+INFO_POOL_REUSE = int(os.environ.get("INFO_POOL_REUSE", 200))  # extractions before a pooled instance is replaced
+PREWARM = os.environ.get("PREWARM", "1") not in ("", "0", "false", "False")  # import yt-dlp and fill the pool at boot
+STATIC_SPLIT = os.environ.get("STATIC_SPLIT", "1") not in ("", "0", "false", "False")  # page CSS/JS as cacheable files
+SIDECAR_THREADS = int(os.environ.get("SIDECAR_THREADS", 4))  # concurrent subtitle / thumbnail fetches of all jobs
+SIDECAR_WAIT_SECONDS = int(os.environ.get("SIDECAR_WAIT_SECONDS", 60))  # final postprocess waits this long for a sidecar
+CLIP_KEYFRAME_TOLERANCE = float(os.environ.get("CLIP_KEYFRAME_TOLERANCE", 0.1))  # seconds a cut may miss a keyframe and still be stream-copied
+CLIP_PROBE_TIMEOUT = int(os.environ.get("CLIP_PROBE_TIMEOUT", 15))  # ffprobe keyframe lookup before a clip download
+# multi-node mode: frontends queue jobs in a shared backend, worker nodes pull and run them
+CLUSTER_BACKEND = os.environ.get("CLUSTER_BACKEND", "")  # "sqlite:////shared/hyper.db" or "redis://host:6379/0" ("" = single node)
+NODE_ID = os.environ.get("NODE_ID", socket.gethostname())
+NODE_URL = os.environ.get("NODE_URL", f"http://{socket.gethostname()}:{PORT}")  # how other nodes reach this one
+NODE_ROLE = os.environ.get("NODE_ROLE", "all")  # "all", "web" (never downloads) or "worker"
+NODE_TIMEOUT = int(os.environ.get("NODE_TIMEOUT", 30))  # a node silent this long is considered gone
+FETCH_ROUTING = os.environ.get("FETCH_ROUTING", "proxy")  # /fetch of another node's file: "proxy" or "redirect"
+SERVER_MODE = os.environ.get("SERVER_MODE", "wsgi")  # "wsgi" (Flask) or "asgi" (asgi_app under uvicorn)
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 32))  # threads running Flask views / file reads in asgi mode
+PROXY_HOPS = int(os.environ.get("PROXY_HOPS", 0))  # reverse proxies in front of the app whose X-Forwarded-For is trusted
 
 app = Flask(__name__)
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
 
 # Save cookies if present (from environment)
 #cookies_data = os.environ.get("COOKIES_TEXT", "").strip()
@@ -279,6 +360,9 @@ footer{margin-top:20px;text-align:center;color:var(--muted);font-size:12px;}
         <select id="format">
           <option value="video">Video (merge bestvideo + bestaudio)</option>
           <option value="audio">Audio only (MP3)</option>
+          <option value="audio_m4a">Audio only (M4A, no re-encode when possible)</option>
+          <option value="audio_opus">Audio only (Opus)</option>
+          <option value="audio_original">Audio only (original stream, no conversion)</option>
         </select>
       </div>
 
@@ -356,10 +440,12 @@ urlIn.addEventListener("input",()=>{
 });
 async function fetchInfo(url){
   try{
-    const r=await fetch("/info",{method:"POST",headers:{"Content-Type":"application/json"},body:JSON.stringify({url})});
+    const format_choice=document.getElementById("format").value,video_res=document.getElementById("video_res").value;
+    const r=await fetch("/info",{method:"POST",headers:{"Content-Type":"application/json"},body:JSON.stringify({url,format_choice,video_res})});
     const j=await r.json();
     if(!r.ok||j.error){preview.style.display="none";return;}
-    pTitle.textContent=j.title||"";pSub.textContent=[j.channel,j.duration_str].filter(Boolean).join(" • ");
+    const size=j.plan&&j.plan.estimated_bytes?"≈ "+(j.plan.estimated_bytes/1048576).toFixed(1)+" MB":"";
+    pTitle.textContent=j.title||"";pSub.textContent=[j.channel,j.duration_str,size].filter(Boolean).join(" • ");
     if(j.thumbnail)thumb.src=j.thumbnail;
     preview.style.display="block";
   }catch(e){preview.style.display="none";}
@@ -380,66 +466,863 @@ function formatMbps(speed_b){
   return mbps.toFixed(1) + " Mbps";
 }
 
-async function poll(){
+function render(p){
+  const pctv=Math.max(0,Math.min(100,p.percent||0));
+  bar.style.width=pctv+"%";pct.textContent=pctv+"%";
+
+  if(p.status==="finished"){msg.textContent="✅ Preparing file...";}
+  else if(p.status==="error"){msg.textContent="❌ "+(p.error||"Download failed");}
+  else msg.textContent = p.status==="downloaded" ? "✅ Download complete (fetching file)..." : p.status || "Downloading…";
+
+  let etaText="--";
+  if(typeof p.eta_seconds !== "undefined" && p.eta_seconds !== null){
+    etaText = formatSeconds(p.eta_seconds);
+  } else {
+    try{
+      const downloaded = p.downloaded_bytes || 0;
+      const total = p.total_bytes || 0;
+      const speed = p.speed_bytes || 0;
+      if(total>0 && downloaded>0 && speed>0 && downloaded < total){
+        const remain = (total - downloaded)/speed;
+        etaText = formatSeconds(remain);
+      } else {
+        etaText="--";
+      }
+    }catch(e){etaText="--";}
+  }
+  etaVal.textContent = etaText;
+  etaEl.title = "Speed: " + formatMbps(p.speed_bytes || 0);
+
+  if(p.status==="finished"){ window.location="/fetch/"+job; job=null; return true; }
+  if(p.status==="error"){ job=null; return true; }
+  return false;
+}
+
+// progress is pushed over SSE; browsers without EventSource long-poll instead
+function poll(){
+  if(!job)return;
+  if(!window.EventSource){ longPoll(-1); return; }
+  const id=job, es=new EventSource("/progress/"+id+"/stream");
+  es.onmessage=(e)=>{ if(job!==id || render(JSON.parse(e.data))) es.close(); };
+  es.onerror=()=>{
+    if(es.readyState===EventSource.CLOSED && job===id){ longPoll(-1); }
+  };
+}
+
+async function longPoll(since){
   if(!job)return;
   try{
-    const r=await fetch("/progress/"+job);
+    const r=await fetch("/progress/"+job+"?since="+since);
     if(r.status===404){msg.textContent="Job expired.";etaVal.textContent="--";job=null;return;}
     const p=await r.json();
-    const pctv=Math.max(0,Math.min(100,p.percent||0));
-    bar.style.width=pctv+"%";pct.textContent=pctv+"%";
-
-    if(p.status==="finished"){msg.textContent="✅ Preparing file...";}
-    else if(p.status==="error"){msg.textContent="❌ "+(p.error||"Download failed");}
-    else msg.textContent = p.status==="downloaded" ? "✅ Download complete (fetching file)..." : p.status || "Downloading…";
-
-    let etaText="--";
-    if(typeof p.eta_seconds !== "undefined" && p.eta_seconds !== null){
-      etaText = formatSeconds(p.eta_seconds);
-    } else {
-      try{
-        const downloaded = p.downloaded_bytes || 0;
-        const total = p.total_bytes || 0;
-        const speed = p.speed_bytes || 0;
-        if(total>0 && downloaded>0 && speed>0 && downloaded < total){
-          const remain = (total - downloaded)/speed;
-          etaText = formatSeconds(remain);
-        } else {
-          etaText="--";
-        }
-      }catch(e){etaText="--";}
-    }
-    etaVal.textContent = etaText;
-    etaEl.title = "Speed: " + formatMbps(p.speed_bytes || 0);
-
-    if(p.status==="finished"){ window.location="/fetch/"+job; job=null; return; }
-    if(p.status==="error"){ job=null; return; }
-    setTimeout(poll,800);
+    if(render(p))return;
+    longPoll(p.version);
   }catch(e){msg.textContent="Network error.";etaVal.textContent="--";job=null;}
 }
 </script>
 </body>
 </html>"""
 
+# ---------- Metrics ----------
+class Metrics:
+    """Minimal Prometheus-style registry: labelled counters and histograms.
+
+    Updates are a dict lookup and an add under one lock, cheap enough for
+    the download hot path. Gauges are computed by callbacks at scrape time.
+    """
+
+    LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+    THROUGHPUT_BUCKETS = tuple(x * 1024 * 1024 for x in (0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> (buckets, {labels: [bucket counts..., sum, count]})
+        self.gauges = {}  # name -> callback returning {labels: value}
+
+    def counter(self, name, help_text):
+        self.help[name] = help_text
+        self.counters[name] = {}
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.help[name] = help_text
+        self.histograms[name] = (buckets, {})
+
+    def gauge(self, name, help_text, fn):
+        self.help[name] = help_text
+        self.gauges[name] = fn
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets, series = self.histograms[name]
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            row = series.get(key)
+            if row is None:
+                row = series[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        out = []
+        with self.lock:
+            counters = {n: dict(v) for n, v in self.counters.items()}
+            histograms = {n: (b, {k: list(r) for k, r in v.items()}) for n, (b, v) in self.histograms.items()}
+        for name, series in counters.items():
+            out += [f"# HELP {name} {self.help[name]}", f"# TYPE {name} counter"]
+            out += [f"{name}{self._labels(k)} {v}" for k, v in series.items()]
+        for name, fn in self.gauges.items():
+            out += [f"# HELP {name} {self.help[name]}", f"# TYPE {name} gauge"]
+            try:
+                out += [f"{name}{self._labels(tuple(sorted(k)))} {v}" for k, v in fn().items()]
+            except Exception:
+                pass
+        for name, (buckets, series) in histograms.items():
+            out += [f"# HELP {name} {self.help[name]}", f"# TYPE {name} histogram"]
+            for key, row in series.items():
+                cum = 0
+                for b, n in zip(buckets + ("+Inf",), row):
+                    cum += n
+                    out.append(f"{name}_bucket{self._labels(key, (('le', b),))} {cum}")
+                out.append(f"{name}_sum{self._labels(key)} {row[-2]}")
+                out.append(f"{name}_count{self._labels(key)} {row[-1]}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.histogram("hyper_phase_seconds", "Time spent per job phase (queue, extract, download, postprocess, find_output, fetch).")
+METRICS.histogram("hyper_job_throughput_bytes_per_second", "Average download throughput per finished job.",
+                  Metrics.THROUGHPUT_BUCKETS)
+METRICS.counter("hyper_download_bytes_total", "Bytes downloaded from upstream by yt-dlp/ffmpeg.")
+METRICS.counter("hyper_fetch_bytes_total", "Bytes sent to clients by /fetch.")
+METRICS.counter("hyper_jobs_total", "Jobs by outcome.")
+METRICS.counter("hyper_errors_total", "Errors by category.")
+
 # ---------- Backend objects ----------
-JOBS = {}
+JOBS = {}  # jobs owned (being run) by this process
 JOBS_LOCK = threading.Lock()
 
+# a job's progress is one immutable snapshot, replaced whole, so readers never see a half-updated mix
+Progress = namedtuple("Progress", "percent downloaded_bytes total_bytes speed_bytes eta_seconds")
+NO_PROGRESS = Progress(0, 0, 0, 0.0, None)
+
+_JOB_CONDITIONS = [threading.Condition() for _ in range(64)]  # striped: jobs share change conditions
+
 class Job:
-    def __init__(self):
+    """A download (or batch) and its progress.
+
+    Slotted because many thousands may be registered: the temp dir is kept
+    as a str, error messages are capped at ERROR_MAX_CHARS, and the change
+    condition is one of a shared stripe (waiters re-check their own job's
+    version, so a wakeup meant for another job is harmless).
+    """
+
+    __slots__ = ("id", "_tmp", "progress", "status", "file", "_error", "created_at", "downloaded_at", "artifact",
+                 "download_name", "leader", "version", "changed", "waiters", "last_seen", "cancel_requested",
+                 "delivery_mode", "stream_path", "ranged", "active_fetches", "kind", "items", "local", "node", "detached")
+
+    def __init__(self, work_dir: str = None):
         self.id = str(uuid.uuid4())
-        # use Path for safety
-        self.tmp = Path(tempfile.mkdtemp(prefix="mvd_"))
-        self.percent = 0
+        self.tmp = Job.make_tmp(work_dir)
+        self.progress = NO_PROGRESS
         self.status = "queued"
         self.file = None
         self.error = None
-        self.speed_bytes = 0.0
         self.created_at = time.time()
         self.downloaded_at = None
-        self.total_bytes = 0
-        self.downloaded_bytes = 0
-        JOBS[self.id] = self
+        self.artifact = None  # digest of the shared artifact this job holds a reference on
+        self.download_name = None
+        self.leader = None  # id of the job producing our artifact when attached to it
+        self.version = 0  # bumped on every published progress change
+        self.changed = _JOB_CONDITIONS[hash(self.id) % len(_JOB_CONDITIONS)]
+        self.waiters = None  # (event loop, future) of ASGI requests waiting for a change
+        self.last_seen = self.created_at  # last /progress poll, for abandonment detection
+        self.cancel_requested = False
+        self.delivery_mode = None  # "file", "progressive" or "fmp4" once run_download has decided
+        self.stream_path = None  # file being written that /fetch can tail in streaming modes
+        self.ranged = False  # a client fetched byte ranges: keep the file around for resumes
+        self.active_fetches = 0  # /fetch responses of this process still sending the file
+        self.kind = "single"  # or "batch": a playlist / URL list fanned out over child jobs
+        self.items = None  # batch only: [{"job_id", "title", "url"}]
+        self.local = True  # False for snapshots of jobs owned by another worker process
+        self.node = NODE_ID  # node whose disk holds the job's files
+        self.detached = False  # cancelled by its client but still producing the artifact for attached jobs
+        JOB_STORE.add(self)
+
+    @staticmethod
+    def make_tmp(work_dir: str = None) -> str:
+        # the pid in the name lets a restarted process tell crash leftovers from live dirs
+        return tempfile.mkdtemp(prefix=f"mvd_{os.getpid()}_", dir=work_dir or WORK_DIR)
+
+    @property
+    def tmp(self) -> Path:
+        return Path(self._tmp)
+
+    @tmp.setter
+    def tmp(self, value):
+        self._tmp = str(value)
+
+    # read-only views of the current snapshot
+    @property
+    def percent(self) -> int:
+        return self.progress.percent
+
+    @property
+    def downloaded_bytes(self) -> int:
+        return self.progress.downloaded_bytes
+
+    @property
+    def total_bytes(self) -> int:
+        return self.progress.total_bytes
+
+    @property
+    def speed_bytes(self) -> float:
+        return self.progress.speed_bytes
+
+    def complete_progress(self, path: str = None):
+        """Mark the progress done; path gives the byte counts of a file this job never downloaded itself."""
+        p = self.progress
+        if path:
+            try:
+                size = os.path.getsize(path)
+                p = p._replace(downloaded_bytes=size, total_bytes=size)
+            except OSError:
+                pass
+        self.progress = p._replace(percent=100, downloaded_bytes=max(p.downloaded_bytes, p.total_bytes),
+                                   eta_seconds=None)
+
+    @property
+    def error(self):
+        return self._error
+
+    @error.setter
+    def error(self, value):
+        self._error = value[:ERROR_MAX_CHARS] if value else value
+
+    # fields shared through the job store
+    PERSISTED = ("id", "progress", "status", "file", "error", "created_at", "downloaded_at", "artifact",
+                 "download_name", "leader", "version", "last_seen", "node", "cancel_requested", "delivery_mode",
+                 "stream_path", "ranged", "kind", "items", "detached")
+
+    def to_dict(self) -> dict:
+        d = {k: getattr(self, k) for k in self.PERSISTED}
+        d["tmp"] = self._tmp
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        """Rebuild a read-only snapshot of a job owned by another process."""
+        job = cls.__new__(cls)
+        for k in cls.PERSISTED:
+            setattr(job, k, d.get(k))
+        job.tmp = d["tmp"]
+        job.progress = Progress(*d["progress"]) if d.get("progress") else NO_PROGRESS
+        job.active_fetches = 0
+        job.changed = _JOB_CONDITIONS[hash(job.id) % len(_JOB_CONDITIONS)]
+        job.waiters = None
+        job.local = False
+        return job
+
+TERMINAL_STATUSES = ("finished", "error", "downloaded")
+
+def notify_job(job: Job):
+    """Publish a progress change: bump the version, persist it and wake /progress waiters.
+
+    Jobs attached to this one report its progress, so they are woken too.
+    """
+    targets = [job]
+    if job.artifact:
+        targets += [f for f in (JOBS.get(fid) for fid in ARTIFACTS.followers(job.artifact, job.id)) if f]
+    for j in targets:
+        with j.changed:
+            j.version += 1
+            j.changed.notify_all()
+            waiters, j.waiters = j.waiters or (), None
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_resolve_waiter, fut)
+        JOB_STORE.save(j)
+        if j.status in TERMINAL_STATUSES:
+            EXPIRY.schedule(j)
+
+def wait_job(job: Job, since: int, timeout: float) -> int:
+    """Block until job.version > since (or timeout); return the current version."""
+    with job.changed:
+        job.changed.wait_for(lambda: job.version > since, timeout)
+        return job.version
+
+def _resolve_waiter(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+async def async_wait_job(job: Job, since: int, timeout: float):
+    """Event-loop twin of JOB_STORE.wait for the ASGI mode; returns (current job, version)."""
+    deadline = time.time() + timeout
+    if not job.local:
+        # owned by another process: poll the store like SqliteJobStore.wait, without blocking the loop
+        while True:
+            fresh = JOB_STORE.get(job.id) or job
+            if fresh.version > since or time.time() >= deadline:
+                return fresh, fresh.version
+            await asyncio.sleep(min(getattr(JOB_STORE, "flush_interval", 0.5), max(0.0, deadline - time.time())))
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    with job.changed:
+        if job.version > since:
+            return job, job.version
+        if job.waiters is None:
+            job.waiters = []
+        job.waiters.append((loop, fut))
+    try:
+        await asyncio.wait_for(fut, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        with job.changed:
+            if job.waiters and (loop, fut) in job.waiters:
+                job.waiters.remove((loop, fut))
+    return job, job.version
+
+class MemoryJobStore:
+    """Default job backend: jobs live only in this process's JOBS dict."""
+
+    def add(self, job: Job):
+        with JOBS_LOCK:
+            JOBS[job.id] = job
+
+    def get(self, job_id: str):
+        return JOBS.get(job_id)
+
+    def remove(self, job_id: str):
+        with JOBS_LOCK:
+            return JOBS.pop(job_id, None)
+
+    def all(self):
+        with JOBS_LOCK:
+            return list(JOBS.values())
+
+    def save(self, job: Job):
+        pass
+
+    def wait(self, job: Job, since: int, timeout: float):
+        """Wait for a change newer than since; returns (current job, version)."""
+        return job, wait_job(job, since, timeout)
+
+    def touch(self, job: Job):
+        """Record that a client is still watching job."""
+        job.last_seen = time.time()
+
+    def sync(self, job: Job):
+        """Pull cancel requests / client activity recorded by other processes into a local job."""
+        pass
+
+class SqliteJobStore(MemoryJobStore):
+    """Job backend shared by all worker processes on one host (SQLite in WAL mode).
+
+    Status transitions are written immediately; plain progress updates only
+    mark the job dirty and are flushed in one transaction every
+    flush_interval seconds, so the progress hook never hits the database.
+    Jobs owned by another process are served as snapshots re-read from the
+    database; waiting on them polls the row instead of a condition variable.
+    Only the owner writes a job's row. Other processes record what they
+    observed (NOTE_FIELDS: polls, cancel requests, fetches) as separate
+    notes that only ever grow, merged into the row when it is read, so
+    neither side can overwrite the other's newer state.
+    """
+
+    NOTE_FIELDS = ("last_seen", "cancel_requested", "downloaded_at", "ranged")
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.db_lock = threading.Lock()
+        self.dirty = set()
+        self.saved_status = {}  # job id -> status last written
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner INTEGER, data TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS notes (id TEXT, field TEXT, value REAL, PRIMARY KEY (id, field))")
+        self._fail_orphans()
+        threading.Thread(target=self._flusher, daemon=True).start()
+
+    # row primitives: (id, owner, data) with the owner kept on update; overridden by ClusterJobStore
+    def _owner(self):
+        return process_token()
+
+    def _alive(self, owner) -> bool:
+        return _process_alive(owner)
+
+    def _store(self, rows):
+        with self.db_lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT INTO jobs (id, owner, data) VALUES (?, ?, ?) "
+                                "ON CONFLICT(id) DO UPDATE SET data = excluded.data", rows)
+            self.db.execute("COMMIT")
+
+    def _row(self, job_id: str):
+        with self.db_lock:
+            row = self.db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _notes(self, job_id: str) -> dict:
+        with self.db_lock:
+            return dict(self.db.execute("SELECT field, value FROM notes WHERE id = ?", (job_id,)).fetchall())
+
+    def _note(self, job_id: str, fields: dict):
+        """Raise the given note fields of a job to at least these values."""
+        with self.db_lock:
+            self.db.executemany("INSERT INTO notes (id, field, value) VALUES (?, ?, ?) "
+                                "ON CONFLICT(id, field) DO UPDATE SET value = max(value, excluded.value)",
+                                [(job_id, k, float(v)) for k, v in fields.items()])
+
+    def _delete(self, job_id: str):
+        with self.db_lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.db.execute("DELETE FROM notes WHERE id = ?", (job_id,))
+
+    def _read(self, job_id: str):
+        """The job's row with the notes of other processes merged in."""
+        d = self._row(job_id)
+        if not d:
+            return None
+        for k, v in self._notes(job_id).items():
+            if k in ("cancel_requested", "ranged"):
+                d[k] = d.get(k) or bool(v)
+            elif v > (d.get(k) or 0):
+                d[k] = v
+                if k == "downloaded_at" and d["status"] == "finished":
+                    d["status"] = "downloaded"  # fetched through another process
+        return d
+
+    def _owners(self):
+        with self.db_lock:
+            return self.db.execute("SELECT id, owner FROM jobs").fetchall()
+
+    def _fail_orphans(self):
+        # jobs that were running in a worker process that no longer exists will never finish
+        for jid, owner in self._owners():
+            if self._alive(owner):
+                continue
+            d = self._read(jid)
+            if not d or d["status"] in TERMINAL_STATUSES:
+                continue
+            d.update(status="error", error="Server restarted")
+            self._store([(jid, owner, json.dumps(d))])
+
+    def _write(self, jobs):
+        owner = self._owner()
+        self._store([(j.id, owner, json.dumps(j.to_dict())) for j in jobs])
+        for j in jobs:
+            self.saved_status[j.id] = j.status
+
+    def _flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                if DEBUG_LOG:
+                    print("[jobstore] flush error:", repr(e))
+
+    def flush(self):
+        with JOBS_LOCK:
+            ids, self.dirty = self.dirty, set()
+        jobs = [j for j in (JOBS.get(i) for i in ids) if j]
+        if jobs:
+            self._write(jobs)
+
+    def add(self, job: Job):
+        super().add(job)
+        self._write([job])
+
+    def get(self, job_id: str):
+        job = JOBS.get(job_id)
+        if job is not None and job.status not in ("finished", "downloaded"):
+            return job
+        d = self._read(job_id)
+        if job is None:
+            return Job.from_dict(d) if d else None
+        if d and (d.get("downloaded_at") or 0) > (job.downloaded_at or 0):
+            # fetched through another worker
+            job.downloaded_at = d["downloaded_at"]
+            job.ranged = job.ranged or d.get("ranged")
+            job.status = "downloaded"
+        return job
+
+    def remove(self, job_id: str):
+        self._delete(job_id)
+        self.saved_status.pop(job_id, None)
+        return super().remove(job_id)
+
+    def all(self):
+        """Jobs this process is responsible for: its own plus those left by dead workers."""
+        jobs = []
+        for jid, owner in self._owners():
+            if jid in JOBS or not self._alive(owner):
+                j = self.get(jid)
+                if j:
+                    jobs.append(j)
+        return jobs
+
+    def save(self, job: Job):
+        if not job.local:
+            self._note(job.id, {k: getattr(job, k) for k in self.NOTE_FIELDS if getattr(job, k)})
+        elif self.saved_status.get(job.id) != job.status:
+            self._write([job])
+        else:
+            with JOBS_LOCK:
+                self.dirty.add(job.id)
+
+    def wait(self, job: Job, since: int, timeout: float):
+        if job.local:
+            return job, wait_job(job, since, timeout)
+        deadline = time.time() + timeout
+        while True:
+            fresh = self.get(job.id) or job
+            if fresh.version > since or time.time() >= deadline:
+                return fresh, fresh.version
+            time.sleep(min(self.flush_interval, max(0.0, deadline - time.time())))
+
+    def touch(self, job: Job):
+        now = time.time()
+        stale = now - (job.last_seen or 0) > max(1.0, ABANDON_SECONDS / 4)
+        job.last_seen = now
+        if not job.local and stale:
+            # polls served by other workers reach the owner as a note, a few times per window
+            self._note(job.id, {"last_seen": now})
+
+    def sync(self, job: Job):
+        d = self._read(job.id)
+        if not d:
+            return
+        job.last_seen = max(job.last_seen or 0, d.get("last_seen") or 0)
+        if d.get("cancel_requested"):
+            job.cancel_requested = True
+
+    def settle(self, job: Job):
+        """Write the final state of a job nobody owns (taken back out of the shared queue)."""
+        self._write([job])
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(int(pid), 0)
+        return True
+    except (OSError, TypeError, ValueError):
+        return False
+
+def _proc_start(pid):
+    """Start time of a process in clock ticks since boot, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{int(pid)}/stat", "rb") as f:
+            return int(f.read().rsplit(b")", 1)[1].split()[19])
+    except (OSError, ValueError, IndexError):
+        return None
+
+_TOKEN = [None, None]  # [pid, token]; recomputed after a fork
+
+def process_token() -> str:
+    """Identify this process in shared state as "<pid>-<start>", unique even when a pid is reused.
+
+    A restarted container gets the same pid (often 1) for a different
+    process, so a bare pid left in a job row or artifact ref would look
+    alive forever.
+    """
+    pid = os.getpid()
+    if _TOKEN[0] != pid:
+        _TOKEN[:] = [pid, f"{pid}-{_proc_start(pid) or int(time.time() * 1000)}"]
+    return _TOKEN[1]
+
+def _process_alive(token) -> bool:
+    """Whether the process that wrote token (or a bare pid, from older versions) still runs."""
+    pid, _, start = str(token).partition("-")
+    if not start:
+        # a bare pid equal to ours was written by an earlier process: we only write tokens
+        return pid != str(os.getpid()) and _pid_alive(pid)
+    if pid == str(os.getpid()):
+        return token == process_token()
+    if not _pid_alive(pid):
+        return False
+    now = _proc_start(pid)
+    return now is None or str(now) == start
+
+# ---------- Cluster mode ----------
+class SqliteClusterBackend:
+    """Shared state of a multi-node deployment in one SQLite file (e.g. on a shared volume).
+
+    Holds the job rows, the download queue (one FIFO per lane) and node
+    heartbeats. Also the local stand-in for Redis when trying the mode out
+    on one machine. Network filesystems need working POSIX locks for this.
+    """
+
+    POLL_SECONDS = 0.5
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner TEXT, data TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS queue (seq INTEGER PRIMARY KEY AUTOINCREMENT, lane TEXT, "
+                        "job_id TEXT, item TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, url TEXT, seen REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS notes (id TEXT, field TEXT, value REAL, PRIMARY KEY (id, field))")
+
+    def store(self, rows, claim: bool = False):
+        """Upsert (id, owner, data) rows; the owner only changes when claiming."""
+        sql = "INSERT INTO jobs (id, owner, data) VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data"
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany(sql + (", owner = excluded.owner" if claim else ""), rows)
+            self.db.execute("COMMIT")
+
+    def load(self, job_id: str):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, job_id: str):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.db.execute("DELETE FROM notes WHERE id = ?", (job_id,))
+
+    def note(self, job_id: str, fields: dict):
+        """Raise note fields of a job (see SqliteJobStore) to at least the given values."""
+        with self.lock:
+            self.db.executemany("INSERT INTO notes (id, field, value) VALUES (?, ?, ?) "
+                                "ON CONFLICT(id, field) DO UPDATE SET value = max(value, excluded.value)",
+                                [(job_id, k, float(v)) for k, v in fields.items()])
+
+    def notes(self, job_id: str) -> dict:
+        with self.lock:
+            return dict(self.db.execute("SELECT field, value FROM notes WHERE id = ?", (job_id,)).fetchall())
+
+    def owners(self):
+        with self.lock:
+            return self.db.execute("SELECT id, owner FROM jobs").fetchall()
+
+    def push(self, lane: str, job_id: str, item: str):
+        with self.lock:
+            self.db.execute("INSERT INTO queue (lane, job_id, item) VALUES (?, ?, ?)", (lane, job_id, item))
+
+    def pop(self, lanes, timeout: float):
+        """Take the oldest item of the first non-empty lane, waiting up to timeout; None if there is none."""
+        deadline = time.time() + timeout
+        marks = ",".join("?" * len(lanes))
+        while True:
+            with self.lock:
+                self.db.execute("BEGIN IMMEDIATE")
+                try:
+                    rows = self.db.execute(f"SELECT seq, lane, item FROM queue WHERE lane IN ({marks})", lanes).fetchall()
+                    row = min(rows, key=lambda r: (lanes.index(r[1]), r[0])) if rows else None
+                    if row:
+                        self.db.execute("DELETE FROM queue WHERE seq = ?", (row[0],))
+                finally:
+                    self.db.execute("COMMIT")
+            if row:
+                return row[2]
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.POLL_SECONDS)
+
+    def unqueue(self, job_id: str) -> bool:
+        with self.lock:
+            return self.db.execute("DELETE FROM queue WHERE job_id = ?", (job_id,)).rowcount > 0
+
+    def depth(self) -> dict:
+        with self.lock:
+            return dict(self.db.execute("SELECT lane, COUNT(*) FROM queue GROUP BY lane").fetchall())
+
+    def heartbeat(self, node: str, url: str):
+        with self.lock:
+            self.db.execute("INSERT INTO nodes (node, url, seen) VALUES (?, ?, ?) ON CONFLICT(node) "
+                            "DO UPDATE SET url = excluded.url, seen = excluded.seen", (node, url, time.time()))
+
+    def nodes(self) -> dict:
+        with self.lock:
+            return {n: (u, seen) for n, u, seen in self.db.execute("SELECT node, url, seen FROM nodes")}
+
+class RedisClusterBackend:
+    """The same shared state in Redis (or anything speaking its protocol): hashes plus one list per lane."""
+
+    def __init__(self, url: str, prefix: str = "hyper:"):
+        import redis  # optional dependency, only needed for CLUSTER_BACKEND=redis://...
+        self.r = redis.Redis.from_url(url, decode_responses=True)
+        self.p = prefix
+
+    def store(self, rows, claim: bool = False):
+        pipe = self.r.pipeline()
+        for jid, owner, data in rows:
+            pipe.hset(self.p + "jobs", jid, data)
+            if claim:
+                pipe.hset(self.p + "owners", jid, owner)
+            else:
+                pipe.hsetnx(self.p + "owners", jid, owner)
+        pipe.execute()
+
+    def load(self, job_id: str):
+        return self.r.hget(self.p + "jobs", job_id)
+
+    # HSET only when the value is larger: notes never go backwards under concurrent writers
+    NOTE_MAX = ("local cur = redis.call('HGET', KEYS[1], ARGV[1]) "
+                "if not cur or tonumber(cur) < tonumber(ARGV[2]) then redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) end")
+
+    def delete(self, job_id: str):
+        self.r.hdel(self.p + "jobs", job_id)
+        self.r.hdel(self.p + "owners", job_id)
+        self.r.delete(self.p + "notes:" + job_id)
+
+    def note(self, job_id: str, fields: dict):
+        pipe = self.r.pipeline()
+        for k, v in fields.items():
+            pipe.eval(self.NOTE_MAX, 1, self.p + "notes:" + job_id, k, float(v))
+        pipe.execute()
+
+    def notes(self, job_id: str) -> dict:
+        return {k: float(v) for k, v in self.r.hgetall(self.p + "notes:" + job_id).items()}
+
+    def owners(self):
+        return list(self.r.hgetall(self.p + "owners").items())
+
+    def push(self, lane: str, job_id: str, item: str):
+        self.r.lpush(self.p + "queue:" + lane, item)
+
+    def pop(self, lanes, timeout: float):
+        got = self.r.brpop([self.p + "queue:" + lane for lane in lanes], timeout=max(1, int(timeout)))
+        return got[1] if got else None
+
+    def unqueue(self, job_id: str) -> bool:
+        for lane in Scheduler.LANES:
+            key = self.p + "queue:" + lane
+            for item in self.r.lrange(key, 0, -1):
+                if json.loads(item)["job_id"] == job_id:
+                    return self.r.lrem(key, 1, item) > 0
+        return False
+
+    def depth(self) -> dict:
+        return {lane: self.r.llen(self.p + "queue:" + lane) for lane in Scheduler.LANES}
+
+    def heartbeat(self, node: str, url: str):
+        self.r.hset(self.p + "nodes", node, json.dumps([url, time.time()]))
+
+    def nodes(self) -> dict:
+        return {n: tuple(json.loads(v)) for n, v in self.r.hgetall(self.p + "nodes").items()}
+
+def cluster_backend(spec: str):
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisClusterBackend(spec)
+    return SqliteClusterBackend(spec[len("sqlite://"):] if spec.startswith("sqlite://") else spec)
+
+class ClusterJobStore(SqliteJobStore):
+    """Job backend of a multi-node deployment: rows live in the shared cluster backend.
+
+    Owners are "<node>/<process token>". An owner on this node is alive while its
+    process is; one on another node while that node keeps heartbeating.
+    Jobs waiting in the shared queue have no owner ("") until a worker
+    node adopts them.
+    """
+
+    def __init__(self, backend, flush_interval: float):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.dirty = set()
+        self.saved_status = {}
+        self.peers = {}  # node -> (url, last heartbeat), refreshed by the heartbeat thread
+        self.peers_at = 0.0
+        self.beat()
+        self._fail_orphans()
+        threading.Thread(target=self._flusher, daemon=True).start()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def _owner(self):
+        return f"{NODE_ID}/{process_token()}"
+
+    def _alive(self, owner) -> bool:
+        if not owner:
+            return True  # queued in the shared queue
+        node, _, token = str(owner).partition("/")
+        if node == NODE_ID:
+            return _process_alive(token)
+        return self.node_alive(node)
+
+    def _store(self, rows):
+        self.backend.store(rows)
+
+    def _row(self, job_id: str):
+        data = self.backend.load(job_id)
+        return json.loads(data) if data else None
+
+    def _notes(self, job_id: str) -> dict:
+        return self.backend.notes(job_id)
+
+    def _note(self, job_id: str, fields: dict):
+        self.backend.note(job_id, fields)
+
+    def _delete(self, job_id: str):
+        self.backend.delete(job_id)
+
+    def _owners(self):
+        return self.backend.owners()
+
+    def beat(self):
+        self.backend.heartbeat(NODE_ID, NODE_URL)
+        self.peers_at = time.time()
+        self.peers = self.backend.nodes()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(max(1.0, NODE_TIMEOUT / 3))
+            try:
+                self.beat()
+            except Exception as e:
+                if DEBUG_LOG:
+                    print("[cluster] heartbeat error:", repr(e))
+
+    def node_alive(self, node: str) -> bool:
+        peer = self.peers.get(node)
+        if not peer or time.time() - peer[1] >= NODE_TIMEOUT:
+            # unknown or stale in our copy: it may have joined or beaten since the last refresh
+            if time.time() - self.peers_at >= 1.0:
+                self.peers_at = time.time()
+                self.peers = self.backend.nodes()
+                peer = self.peers.get(node)
+        return bool(peer) and time.time() - peer[1] < NODE_TIMEOUT
+
+    def node_url(self, node: str):
+        return self.peers[node][0] if self.node_alive(node) else None
+
+    def hand_off(self, job: Job):
+        """Give a new job to the shared queue: the row stays, unowned, and the local copy goes."""
+        self.backend.store([(job.id, "", json.dumps(job.to_dict()))], claim=True)
+        with JOBS_LOCK:
+            JOBS.pop(job.id, None)
+        shutil.rmtree(job._tmp, ignore_errors=True)
+
+    def adopt(self, job: Job):
+        """Take ownership of a job pulled from the shared queue."""
+        with JOBS_LOCK:
+            JOBS[job.id] = job
+        self.backend.store([(job.id, self._owner(), json.dumps(job.to_dict()))], claim=True)
+        self.saved_status[job.id] = job.status
+
+if CLUSTER_BACKEND:
+    JOB_STORE = ClusterJobStore(cluster_backend(CLUSTER_BACKEND), JOB_STORE_FLUSH_INTERVAL)
+elif JOB_STORE_BACKEND == "sqlite":
+    JOB_STORE = SqliteJobStore(JOB_DB_PATH, JOB_STORE_FLUSH_INTERVAL)
+else:
+    JOB_STORE = MemoryJobStore()
 
 URL_RE = re.compile(r"^https?://", re.I)
 _FILENAME_SANITIZE_RE = re.compile(r'[\\/:*?"<>|]')
@@ -470,262 +1353,2702 @@ def _build_video_format(video_res):
     parts.append("bestvideo+bestaudio/best")
     return "/".join(parts)
 
-# ThreadPool to limit concurrent downloads
-executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT)
+# format_choice -> (yt-dlp format, target codec); None keeps the downloaded stream untouched
+AUDIO_FORMATS = {
+    "audio": ("bestaudio[ext=m4a]/bestaudio/best", "mp3"),
+    "audio_m4a": ("bestaudio[ext=m4a]/bestaudio/best", "m4a"),
+    "audio_opus": ("bestaudio[acodec=opus]/bestaudio/best", "opus"),
+    "audio_original": ("bestaudio/best", None),
+}
 
-def _find_output_file(tmpdir: Path, prefix_base: str):
-    """Find largest matching file that starts with prefix_base in tmpdir."""
-    # prefix may contain percent-templates if user used templates; but our outtmpl uses prefix_base + '__'
-    candidates = list(tmpdir.glob(f"{prefix_base}__*"))
-    # If postprocessor created mp3, extension may differ; include any extension.
-    if not candidates:
-        # fallback: all files
-        candidates = list(tmpdir.iterdir())
-    # pick largest regular file
-    files = [p for p in candidates if p.is_file()]
-    if not files:
-        return None
-    return max(files, key=lambda p: p.stat().st_size)
+def is_audio(fmt_key: str) -> bool:
+    return fmt_key in AUDIO_FORMATS
 
-def _run_yt_dlp_extract(job: Job, opts: dict, url: str):
-    """Run extraction and return True/False. Exceptions handled by caller."""
-    with YoutubeDL(opts) as y:
-        y.extract_info(url, download=True)
-    return True
+def _audio_postprocessors(target, formats, abitrate) -> list:
+    """FFmpegExtractAudio to target, or nothing when the selected stream already is target (no re-encode)."""
+    if not target or not HAS_FFMPEG:
+        return []
+    f = formats[0] if formats else {}
+    acodec = (f.get("acodec") or "").split(".")[0]
+    if (target == "m4a" and f.get("ext") == "m4a" and acodec in ("mp4a", "aac")) or (target == "mp3" and acodec == "mp3"):
+        return []
+    pp = {"key": "FFmpegExtractAudio", "preferredcodec": target}
+    if target in ("mp3", "m4a"):
+        pp["preferredquality"] = str(abitrate) if abitrate else "192"
+    return [pp]
 
-def run_download(job: Job, url: str, fmt_key: str, filename: str = None, video_res=None, audio_bitrate=None):
-    """Optimized run_download: strict audio format, safe filename, postprocessors, limited logging."""
-    try:
-        if not URL_RE.match(url):
-            job.status = "error"
-            job.error = "Invalid URL"
-            return
+# ---------- Format planner ----------
+# postprocessing cost of each plan kind, cheapest first
+PLAN_COSTS = {"progressive": 0, "audio": 0, "merge_copy": 1, "merge": 2}
 
-        # normalize inputs
-        try:
-            vres = int(video_res) if video_res else None
-        except Exception:
-            vres = None
-        try:
-            abitrate = int(audio_bitrate) if audio_bitrate else None
-        except Exception:
-            abitrate = None
+def _format_size(f: dict, duration) -> int:
+    size = f.get("filesize") or f.get("filesize_approx")
+    if not size and f.get("tbr") and duration:
+        size = f["tbr"] * 1000 / 8 * duration
+    return int(size or 0)
 
-        # Format selection
-        if fmt_key == "audio":
-            fmt = "bestaudio[ext=m4a]/bestaudio/best"
-        else:
-            fmt = _build_video_format(vres)
+def _usable(f: dict) -> bool:
+    # skip storyboards, DRM and manifest-only entries
+    return (not f.get("has_drm") and f.get("format_id") and f.get("ext") != "mhtml"
+            and not str(f.get("protocol", "")).startswith(("m3u8", "http_dash_segments")))
 
-        # progress hook (keeps job fields)
-        def hook(d):
-            try:
-                st = d.get("status")
-                if st == "downloading":
-                    job.status = "downloading"
-                    total = d.get("total_bytes") or d.get("total_bytes_estimate") or 0
-                    downloaded = d.get("downloaded_bytes", 0) or 0
-                    job.total_bytes = int(total or 0)
-                    job.downloaded_bytes = int(downloaded or 0)
-                    job.speed_bytes = d.get("speed") or 0
-                    if job.total_bytes:
-                        # percent safe compute
-                        job.percent = int(min(100, max(0, (job.downloaded_bytes * 100) / job.total_bytes)))
-                elif st == "finished":
-                    job.percent = 100
-            except Exception:
-                # swallow hook errors to avoid crashing yt-dlp
-                pass
+def plan_formats(formats: list, fmt_key: str = "video", video_res=None, duration=None, has_ffmpeg: bool = True):
+    """Pick the cheapest way to deliver a request from an extracted formats list.
 
-        # filename handling (preserve template tokens if provided)
-        base_template = (filename.strip() if filename else "%(title)s").rstrip(".")
-        if "%(" in base_template and ")" in base_template:
-            # keep template tokens, sanitize outside tokens
-            def _replace_outside_tokens(s):
-                out = []
-                i = 0
-                while i < len(s):
-                    if s[i] == '%' and i+1 < len(s) and s[i+1] == '(':
-                        j = i+2
-                        while j < len(s) and s[j] != ')':
-                            j += 1
-                        if j < len(s):
-                            out.append(s[i:j+1])
-                            i = j+1
-                            continue
-                        else:
-                            out.append(s[i:])
-                            break
-                    else:
-                        out.append(s[i])
-                        i += 1
-                joined = "".join(out)
-                return _FILENAME_SANITIZE_RE.sub("_", joined)
-            safe_base = _replace_outside_tokens(base_template)
+    Pure function of the recorded list (no yt-dlp calls), so it can be
+    checked offline. Video keeps the best height available up to video_res
+    and, at that height, prefers a progressive file (no merge) over an
+    mp4+m4a stream-copy merge over any other merge, then the fewest bytes.
+    Audio prefers streams matching the target codec (no re-encode), then
+    the highest bitrate. Returns None when nothing fits, e.g. an
+    empty list; callers then fall back to a yt-dlp format string.
+    """
+    formats = [f for f in formats or [] if _usable(f)]
+    video = [f for f in formats if f.get("vcodec") not in (None, "none")]
+    audio = [f for f in formats if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")]
+    if fmt_key in AUDIO_FORMATS:
+        target = AUDIO_FORMATS[fmt_key][1]
+        if not audio:
+            return None
+        if target == "opus":
+            preferred = [f for f in audio if str(f.get("acodec", "")).startswith("opus")]
+        elif target in ("m4a", "mp3"):
+            preferred = [f for f in audio if f.get("ext") == "m4a"]
         else:
-            safe_base = sanitize_filename(base_template)
-
-        prefix_safe = _FILENAME_SANITIZE_RE.sub("_", APP_PREFIX.strip() or "Hyper_Downloader")
-        outtmpl_base = f"{prefix_safe}__{safe_base}"
-        outtmpl = str(job.tmp.joinpath(outtmpl_base + ".%(ext)s"))
+            preferred = []
+        pool = preferred or audio
+        best = max(pool, key=lambda f: (f.get("abr") or f.get("tbr") or 0, -_format_size(f, duration)))
+        return {"format": best["format_id"], "kind": "audio", "ext": best.get("ext"),
+                "acodec": best.get("acodec"), "abr": best.get("abr"), "estimated_bytes": _format_size(best, duration)}
+    try:
+        res = int(video_res) if video_res else None
+    except (TypeError, ValueError):
+        res = None
+    progressive = [f for f in video if f.get("acodec") not in (None, "none")]
+    video_only = [f for f in video if f.get("acodec") == "none"]
+    candidates = progressive + (video_only if has_ffmpeg and audio else [])
+    fitting = [f for f in candidates if not res or (f.get("height") or 0) <= res]
+    if fitting:
+        height = max(f.get("height") or 0 for f in fitting)
+    elif candidates:
+        # everything is above the requested height: take the smallest one there is
+        fitting = candidates
+        height = min(f.get("height") or 0 for f in fitting)
+    else:
+        return None
+    plans = []
+    for f in fitting:
+        if (f.get("height") or 0) != height:
+            continue
+        size = _format_size(f, duration)
+        if f in progressive:
+            plans.append({"format": f["format_id"], "kind": "progressive", "ext": f.get("ext"), "estimated_bytes": size})
+            continue
+        copy = f.get("ext") == "mp4"
+        pairs = [a for a in audio if a.get("ext") == "m4a"] if copy else []
+        kind = "merge_copy" if pairs else "merge"
+        a = max(pairs or audio, key=lambda a: (a.get("abr") or a.get("tbr") or 0, -_format_size(a, duration)))
+        plans.append({"format": f"{f['format_id']}+{a['format_id']}", "kind": kind, "ext": "mp4",
+                      "estimated_bytes": size + _format_size(a, duration)})
+    best = min(plans, key=lambda p: (PLAN_COSTS[p["kind"]], p["estimated_bytes"] or float("inf")))
+    best["height"] = height
+    return best
 
-        opts = {
-    "format": fmt,
-    "outtmpl": outtmpl,
-    "progress_hooks": [hook],
+# ---------- Metadata cache ----------
+# extractor options shared by /info and run_download, so a cached info dict
+# (format URLs included) is valid for the download that follows the preview
+EXTRACT_OPTS = {
     "quiet": True,
     "no_warnings": True,
     "noplaylist": True,
-    "retries": 5,
-    "fragment_retries": 5,
     "socket_timeout": 20,
     "force_ipv4": True,
-
     "extractor_args": {
         "youtube": {
             "player_client": ["android"]
         }
     },
-
     "http_headers": {
         "User-Agent": "Mozilla/5.0"
     },
-
     "geo_bypass": True,
-    "nocheckcertificate": True
-        }
+    "nocheckcertificate": True,
+}
 
-        if DEBUG_LOG:
-            opts["verbose"] = True
+_YTDLP = None
 
-        # Audio postprocessing (convert to mp3) only if ffmpeg present
-        if fmt_key == "audio":
-            if HAS_FFMPEG:
-                pp = {"key": "FFmpegExtractAudio", "preferredcodec": "mp3"}
-                pp["preferredquality"] = str(abitrate) if abitrate else "192"
-                opts["postprocessors"] = [pp]
-            # Important: do NOT set merge_output_format for audio
-        else:
-            if HAS_FFMPEG:
-                opts["ffmpeg_location"] = _FFMPEG
-                # set merge only for video 
-                try:
-                    if vres and int(vres) <= 1080:
-                        opts["merge_output_format"] = "mp4"
-                    else:
-                        opts["merge_output_format"] = "mp4"
-                except Exception:
-                    opts["merge_output_format"] = "mp4"
+def _yt_dlp():
+    """The yt_dlp module, imported on first use so the app answers requests before it has loaded."""
+    global _YTDLP
+    if _YTDLP is None:
+        t0 = time.perf_counter()
+        import yt_dlp
+        import yt_dlp.extractor
+        if _YTDLP is None:
+            STARTUP["yt_dlp_import"] = round(time.perf_counter() - t0, 3)
+        _YTDLP = yt_dlp
+    return _YTDLP
 
-        # run yt-dlp inside try-except
-        try:
-            if DEBUG_LOG:
+def YoutubeDL(params=None):
+    """yt_dlp.YoutubeDL (imports yt-dlp if needed)."""
+    return _yt_dlp().YoutubeDL(params)
+
+class ExtractorPool:
+    """Reusable YoutubeDL instances for /info extraction, whose options never change.
+
+    An instance keeps its initialized extractors between uses, so only the
+    first extraction per site pays for setting them up. YoutubeDL is not
+    thread safe: each instance serves one extraction at a time, and when all
+    are busy a throwaway one is built. Instances are replaced after reuse
+    extractions so per-instance state can't grow without bound.
+    """
+
+    def __init__(self, size: int, reuse: int):
+        self.size = size
+        self.reuse = max(1, reuse)
+        self.lock = threading.Lock()
+        self.idle = []  # [YoutubeDL, uses]
+        self.created = 0
+
+    def _new(self) -> list:
+        self.created += 1
+        return [YoutubeDL(dict(EXTRACT_OPTS, skip_download=True)), 0]
+
+    def warm(self):
+        """Fill the pool and initialize the YouTube extractor ahead of the first /info."""
+        while len(self.idle) < self.size:
+            entry = self._new()
+            get_ie = getattr(entry[0], "get_info_extractor", None)
+            if get_ie:
+                get_ie("Youtube")
+            with self.lock:
+                self.idle.append(entry)
+
+    def extract(self, url: str) -> dict:
+        with self.lock:
+            entry = self.idle.pop() if self.idle else None
+        if entry is None:
+            entry = self._new()
+        try:
+            return entry[0].extract_info(url, download=False)
+        finally:
+            entry[1] += 1
+            with self.lock:
+                keep = entry[1] < self.reuse and len(self.idle) < self.size
+                if keep:
+                    self.idle.append(entry)
+            if not keep:
+                entry[0].__exit__(None, None, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"idle": len(self.idle), "size": self.size, "created": self.created}
+
+EXTRACTOR_POOL = ExtractorPool(INFO_POOL_SIZE, INFO_POOL_REUSE)
+
+_EXTRACTORS = None
+
+def video_key(url: str) -> str:
+    """Canonical cache key for a URL: '<extractor>:<video id>' when resolvable, else the URL."""
+    global _EXTRACTORS
+    url = (url or "").strip()
+    if _EXTRACTORS is None:
+        _EXTRACTORS = [ie for ie in _yt_dlp().extractor.gen_extractor_classes() if ie.ie_key() != "Generic"]
+    for ie in _EXTRACTORS:
+        try:
+            if ie.suitable(url):
+                vid = ie.get_temp_id(url)
+                if vid:
+                    return f"{ie.ie_key()}:{vid}"
+                break
+        except Exception:
+            continue
+    return url
+
+class InfoCache:
+    """TTL + LRU cache of extracted info dicts with single-flight extraction per video."""
+
+    def __init__(self, ttl: int, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires_at, info)
+        self.inflight = {}  # key -> [Event, info, exception]
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # joined an extraction already in flight
+
+    def get(self, key):
+        with self.lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, info):
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, info)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get_or_extract(self, url: str):
+        """Return a private copy of the info dict for url, extracting at most once per video."""
+        key = video_key(url)
+        with self.lock:
+            info = self._get_locked(key)
+            if info is not None:
+                self.hits += 1
+                return copy.deepcopy(info)
+            slot = self.inflight.get(key)
+            leader = slot is None
+            if leader:
+                self.misses += 1
+                slot = [threading.Event(), None, None]
+                self.inflight[key] = slot
+            else:
+                self.coalesced += 1
+        if not leader:
+            # another request is extracting this video; wait for its result
+            slot[0].wait()
+            if slot[2] is not None:
+                raise slot[2]
+            return copy.deepcopy(slot[1])
+        try:
+            info = EXTRACTOR_POOL.extract(url)
+            slot[1] = info
+            if info and info.get("_type", "video") == "video":
+                self.put(key, info)
+            return copy.deepcopy(info)
+        except Exception as e:
+            slot[2] = e
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            slot[0].set()
+
+INFO_CACHE = InfoCache(INFO_CACHE_TTL, INFO_CACHE_SIZE)
+
+# ---------- Result (artifact) cache ----------
+def artifact_key(url: str, fmt_key: str, video_res=None, audio_bitrate=None, delivery="file", sidecars=None,
+                 clip=None) -> str:
+    """Cache key for a finished download: (video id, format_choice, video_res, audio_bitrate, sidecars, clip).
+
+    Parameters that do not influence the output for the chosen format are
+    dropped so e.g. audio jobs with different video_res share one artifact.
+    """
+    try:
+        vres = int(video_res) if video_res else None
+    except Exception:
+        vres = None
+    try:
+        abitrate = int(audio_bitrate) if audio_bitrate else None
+    except Exception:
+        abitrate = None
+    if is_audio(fmt_key):
+        vres = None
+        # the bitrate only matters when the audio may be re-encoded
+        abitrate = (abitrate or 192) if HAS_FFMPEG and AUDIO_FORMATS[fmt_key][1] in ("mp3", "m4a") else None
+    else:
+        fmt_key = "video"
+        abitrate = None
+    key = f"{video_key(url)}|{fmt_key}|{vres}|{abitrate}"
+    if sidecars:
+        key += "|subs=" + ",".join(sidecars["subtitles"]) + "|thumb" * sidecars["thumbnail"] + "|meta" * sidecars["metadata"]
+    if clip:
+        key += f"|clip={clip['start']}-{clip['end']}|{clip['mode']}"
+    # streamed jobs may pick a different (single-file) format, so don't share with file jobs
+    return key + "|stream" if delivery == "stream" else key
+
+class ArtifactStore:
+    """Shared on-disk store of finished downloads, keyed by artifact_key().
+
+    Every artifact lives in its own directory named after the key digest.
+    All processes using the directory share one index (SQLite, next to the
+    artifacts) of the entries and of the references jobs and in-progress
+    /fetch streams hold on them, counted per process so those of a dead
+    worker are dropped. Only unreferenced artifacts are evicted (LRU-first)
+    when the store exceeds max_bytes or an artifact is older than ttl.
+    Attaching to a running producer (claim) stays within one process.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, ttl: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.inflight = {}  # digest -> {"job": producer job id, "followers": [(job id, filename)]}
+        self.hits = 0
+        self.misses = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(root / "index.db"), check_same_thread=False, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS artifacts (digest TEXT PRIMARY KEY, path TEXT, size INTEGER, "
+                        "created_at REAL, used_at REAL)")
+        # refs.pid holds the process token of the holder
+        self.db.execute("CREATE TABLE IF NOT EXISTS refs (digest TEXT, pid INTEGER, n INTEGER, PRIMARY KEY (digest, pid))")
+        self._tx(self._load)
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _tx(self, fn, *args):
+        """Run fn(*args) in one write transaction on the index, serialized with the other processes."""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(*args)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return out
+
+    def _load(self):
+        # adopt artifacts left by a previous run, drop broken leftovers and interrupted publishes
+        self._drop_dead_refs()
+        known = {d for (d,) in self.db.execute("SELECT digest FROM artifacts")}
+        for d in self.root.iterdir():
+            if not d.is_dir():
+                continue
+            if d.name.startswith("."):
+                # staging dir ".<digest>_<process token>_*": another worker may be publishing into it
+                if not _process_alive(d.name.split("_")[1]):
+                    shutil.rmtree(str(d), ignore_errors=True)
+                continue
+            if d.name in known:
+                continue
+            files = [p for p in d.iterdir() if p.is_file()]
+            if len(files) != 1:
+                shutil.rmtree(str(d), ignore_errors=True)
+                continue
+            st = files[0].stat()
+            self.db.execute("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)",
+                            (d.name, str(files[0]), st.st_size, st.st_mtime, st.st_mtime))
+        for digest, path in self.db.execute("SELECT digest, path FROM artifacts").fetchall():
+            if not os.path.exists(path):
+                self.db.execute("DELETE FROM artifacts WHERE digest = ?", (digest,))
+
+    def _drop_dead_refs(self):
+        for (pid,) in self.db.execute("SELECT DISTINCT pid FROM refs").fetchall():
+            if not _process_alive(pid):
+                self.db.execute("DELETE FROM refs WHERE pid = ?", (pid,))
+
+    def _ref(self, digest: str):
+        self.db.execute("INSERT INTO refs VALUES (?, ?, 1) ON CONFLICT(digest, pid) DO UPDATE SET n = n + 1",
+                        (digest, process_token()))
+        self.db.execute("UPDATE artifacts SET used_at = ? WHERE digest = ?", (time.time(), digest))
+
+    def _total(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0]
+
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return self._total()
+
+    @property
+    def count(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM artifacts").fetchone()[0]
+
+    def acquire(self, digest: str):
+        """Take a reference on a cached artifact; returns its path or None."""
+        return self._tx(self._acquire, digest)
+
+    def _acquire(self, digest: str):
+        row = self.db.execute("SELECT path FROM artifacts WHERE digest = ?", (digest,)).fetchone()
+        if not row:
+            return None
+        if not os.path.exists(row[0]):
+            self.db.execute("DELETE FROM artifacts WHERE digest = ?", (digest,))
+            return None
+        self._ref(digest)
+        return row[0]
+
+    def release(self, digest: str):
+        self._tx(self._release, digest)
+
+    def _release(self, digest: str):
+        self.db.execute("UPDATE refs SET n = n - 1 WHERE digest = ? AND pid = ?", (digest, process_token()))
+        self.db.execute("DELETE FROM refs WHERE n <= 0")
+        self._evict()
+
+    def lookup(self, digest: str):
+        """Return the acquired path of a cached artifact, or None on a miss."""
+        path = self.acquire(digest)
+        with self.lock:
+            if path:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path
+
+    def claim(self, digest: str, job_id: str, filename=None):
+        """Make job_id the producer of digest, or attach it as a follower of the running producer.
+
+        Returns the producer's job id when attached, None when job_id is now the producer.
+        """
+        with self.lock:
+            running = self.inflight.get(digest)
+            if running:
+                running["followers"].append((job_id, filename))
+                return running["job"]
+            self.inflight[digest] = {"job": job_id, "followers": []}
+            return None
+
+    def followers(self, digest: str, job_id: str):
+        """Ids of the jobs attached to job_id's run for digest."""
+        with self.lock:
+            running = self.inflight.get(digest)
+            if not running or running["job"] != job_id:
+                return []
+            return [fid for fid, _ in running["followers"]]
+
+    def leave(self, digest: str, producer_id: str, job_id: str) -> int:
+        """Detach follower job_id from producer_id's run; returns the number of followers left."""
+        with self.lock:
+            running = self.inflight.get(digest)
+            if not running or running["job"] != producer_id:
+                return 0
+            running["followers"] = [f for f in running["followers"] if f[0] != job_id]
+            return len(running["followers"])
+
+    def unclaim(self, digest: str, job_id: str):
+        """Drop job_id as producer of digest and return the followers waiting on it."""
+        with self.lock:
+            running = self.inflight.get(digest)
+            if not running or running["job"] != job_id:
+                return []
+            del self.inflight[digest]
+            return running["followers"]
+
+    def publish(self, digest: str, src: Path) -> str:
+        """Move a finished file into the store and return its acquired path."""
+        staging = Path(tempfile.mkdtemp(prefix=f".{digest}_{process_token()}_", dir=str(self.root)))
+        shutil.move(str(src), str(staging / src.name))
+        return self._tx(self._publish, digest, staging, src.name)
+
+    def _publish(self, digest: str, staging: Path, name: str) -> str:
+        row = self.db.execute("SELECT path FROM artifacts WHERE digest = ?", (digest,)).fetchone()
+        self._drop_dead_refs()
+        if row and os.path.exists(row[0]) and self.db.execute(
+                "SELECT 1 FROM refs WHERE digest = ?", (digest,)).fetchone():
+            # somebody is still streaming the old copy; keep it and serve theirs
+            shutil.rmtree(str(staging), ignore_errors=True)
+            self._ref(digest)
+            return row[0]
+        target_dir = self.root / digest
+        shutil.rmtree(str(target_dir), ignore_errors=True)
+        os.replace(str(staging), str(target_dir))
+        path = str(target_dir / name)
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)",
+                        (digest, path, os.path.getsize(path), now, now))
+        self._ref(digest)
+        self._evict()
+        return path
+
+    def expire(self):
+        self._tx(self._evict)
+
+    def reclaim(self, nbytes: int) -> int:
+        """Evict unreferenced artifacts LRU-first until nbytes are freed; returns the bytes freed."""
+        return self._tx(self._reclaim, nbytes)
+
+    def _reclaim(self, nbytes: int) -> int:
+        self._drop_dead_refs()
+        freed = 0
+        for digest, size, _ in self._unreferenced():
+            if freed >= nbytes:
+                break
+            self._remove(digest)
+            freed += size
+        return freed
+
+    def _unreferenced(self):
+        return self.db.execute("SELECT digest, size, created_at FROM artifacts "
+                               "WHERE digest NOT IN (SELECT digest FROM refs) ORDER BY used_at").fetchall()
+
+    def _remove(self, digest: str):
+        self.db.execute("DELETE FROM artifacts WHERE digest = ?", (digest,))
+        shutil.rmtree(str(self.root / digest), ignore_errors=True)
+
+    def _evict(self):
+        self._drop_dead_refs()
+        now = time.time()
+        total = self._total()
+        for digest, size, created_at in self._unreferenced():
+            if total <= self.max_bytes and now - created_at <= self.ttl:
+                continue
+            self._remove(digest)
+            total -= size
+            if DEBUG_LOG:
+                print(f"[DEBUG] evicted artifact {digest} ({size} bytes)")
+
+ARTIFACTS = ArtifactStore(Path(ARTIFACT_DIR), ARTIFACT_CACHE_BYTES, ARTIFACT_TTL_SECONDS)
+
+# ---------- Storage ----------
+class StorageFull(Exception):
+    pass
+
+class StorageManager:
+    """Disk admission for downloads.
+
+    A job reserves its projected size (selected formats, doubled when a
+    merge or conversion keeps both copies on disk for a while) before it
+    starts writing. The reservation must fit STORAGE_QUOTA_BYTES together
+    with the result cache, and the job's volume must keep min_free bytes
+    free after what running jobs have yet to write. Under pressure
+    unreferenced cached artifacts are evicted first, then finished jobs
+    nobody has fetched yet, oldest first; otherwise the job waits for space.
+    """
+
+    def __init__(self, quota: int, min_free: int, wait_seconds: int):
+        self.quota = quota
+        self.min_free = min_free
+        self.wait_seconds = wait_seconds
+        self.lock = threading.Lock()
+        self.reserved = {}  # job id -> (volume dir, bytes)
+        self.evicted_jobs = 0
+
+    @staticmethod
+    def dir_for(fmt_key: str) -> str:
+        """Volume for a job's temp dir: audio jobs may use a faster (tmpfs) one."""
+        return AUDIO_WORK_DIR if is_audio(fmt_key) else WORK_DIR
+
+    def _outstanding(self, volume: str) -> int:
+        # bytes running jobs on volume have reserved but not written yet
+        total = 0
+        for jid, (vol, n) in self.reserved.items():
+            if vol == volume:
+                j = JOBS.get(jid)
+                total += max(0, n - (j.downloaded_bytes if j else 0))
+        return total
+
+    def _shortfall(self, volume: str, nbytes: int) -> int:
+        """Bytes that must be freed before nbytes fit (0 = fits)."""
+        short = 0
+        if self.quota:
+            used = sum(n for _, n in self.reserved.values()) + ARTIFACTS.total_bytes
+            short = used + nbytes - self.quota
+        try:
+            free = shutil.disk_usage(volume).free
+        except OSError:
+            return max(0, short)
+        return max(0, short, self.min_free + self._outstanding(volume) + nbytes - free)
+
+    def admit(self, job: Job, nbytes: int):
+        """Reserve nbytes for job, freeing space or waiting as needed; raises StorageFull."""
+        volume = str(job.tmp.parent)
+        deadline = time.time() + self.wait_seconds
+        while True:
+            with self.lock:
+                short = self._shortfall(volume, nbytes)
+                if not short:
+                    self.reserved[job.id] = (volume, nbytes)
+                    return
+            if self._make_room(short):
+                continue
+            if job.cancel_requested:
+                raise JobCancelled()
+            if time.time() >= deadline:
+                raise StorageFull("Not enough disk space on the server, try again later")
+            time.sleep(1.0)
+
+    def release(self, job_id: str):
+        with self.lock:
+            self.reserved.pop(job_id, None)
+
+    def _make_room(self, nbytes: int) -> bool:
+        """Free nbytes: unreferenced artifacts first, then unfetched finished jobs. Returns True on progress."""
+        freed = ARTIFACTS.reclaim(nbytes)
+        if freed >= nbytes:
+            return True
+        victims = sorted((j for j in JOB_STORE.all()
+                          if j.local and j.status == "finished" and j.file and not j.active_fetches),
+                         key=lambda j: j.created_at)
+        for j in victims:
+            if freed >= nbytes:
+                break
+            path, digest = j.file, j.artifact
+            j.file = None
+            j.status = "error"
+            j.error = "File removed to free disk space; start the download again"
+            self.evicted_jobs += 1
+            notify_job(j)
+            if digest:
+                ARTIFACTS.release(digest)
+                freed += ARTIFACTS.reclaim(nbytes - freed)
+            else:
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    pass
+            if DEBUG_LOG:
+                print(f"[storage] evicted unfetched job {j.id} to free space")
+        return freed > 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            reserved = sum(n for _, n in self.reserved.values())
+        out = {"quota": self.quota, "reserved": reserved, "cache_bytes": ARTIFACTS.total_bytes,
+               "evicted_jobs": self.evicted_jobs, "volumes": {}}
+        for vol in {WORK_DIR, AUDIO_WORK_DIR}:
+            try:
+                out["volumes"][vol] = shutil.disk_usage(vol).free
+            except OSError:
+                pass
+        return out
+
+STORAGE = StorageManager(STORAGE_QUOTA_BYTES, STORAGE_MIN_FREE_BYTES, STORAGE_WAIT_SECONDS)
+
+def _estimate_bytes(formats, opts: dict, duration) -> int:
+    """Projected peak disk use of a download of the selected formats."""
+    total = sum(_format_size(f, duration) for f in formats)
+    if not total:
+        return STORAGE_DEFAULT_ESTIMATE
+    if len(formats) > 1 or opts.get("postprocessors"):
+        # merging / converting writes the output while the inputs still exist
+        total *= 2
+    return total
+
+def _download_name(filename, path: str) -> str:
+    """Name a cached artifact after the requester's filename when it has no template tokens."""
+    if filename and filename.strip() and "%(" not in filename:
+        prefix_safe = _FILENAME_SANITIZE_RE.sub("_", APP_PREFIX.strip() or "Hyper_Downloader")
+        base = sanitize_filename(filename.strip().rstrip("."))
+        return f"{prefix_safe}__{base}{Path(path).suffix}"
+    return os.path.basename(path)
+
+# ---------- Download scheduler ----------
+def job_lane(fmt_key: str) -> str:
+    """Audio-only jobs are short; keep them out from behind long video merges."""
+    return "audio" if is_audio(fmt_key) else "video"
+
+class Scheduler:
+    """Bounded, per-client fair download queue with separate audio/video lanes.
+
+    MAX_CONCURRENT worker threads run jobs; the first AUDIO_RESERVED_SLOTS
+    of them only take audio jobs, the rest alternate between lanes. Inside a
+    lane clients are served round-robin, so one client queueing many jobs
+    cannot starve the others.
+    """
+
+    LANES = ("audio", "video")
+
+    def __init__(self, workers: int, audio_slots: int, max_queued: int, max_per_client: int):
+        self.cond = threading.Condition()
+        self.lanes = {lane: OrderedDict() for lane in self.LANES}  # lane -> client -> deque of entries
+        self.queued = {}  # job id -> (lane, client)
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.workers = workers
+        self.active = 0
+        self.running = {}  # job id -> worker token of the thread running it
+        self.last_lane = "video"
+        audio_slots = min(audio_slots, workers - 1) if workers > 1 else 0
+        for i in range(workers):
+            threading.Thread(target=self._worker, args=(i < audio_slots,), daemon=True).start()
+
+    def submit(self, job: Job, client: str, lane: str, fn, *args) -> bool:
+        """Queue fn(*args) for job; returns False when the queue (or client's share) is full."""
+        with self.cond:
+            if len(self.queued) >= self.max_queued:
+                return False
+            if sum(1 for _, c in self.queued.values() if c == client) >= self.max_per_client:
+                return False
+            self.lanes[lane].setdefault(client, deque()).append((job, fn, args))
+            self.queued[job.id] = (lane, client)
+            # wake every idle worker: audio-only workers cannot take video jobs
+            self.cond.notify_all()
+        return True
+
+    def cancel(self, job_id: str):
+        """Remove a still-queued job; returns the Job or None if it is not queued."""
+        with self.cond:
+            where = self.queued.pop(job_id, None)
+            if not where:
+                return None
+            lane, client = where
+            q = self.lanes[lane][client]
+            entry = next(e for e in q if e[0].id == job_id)
+            q.remove(entry)
+            if not q:
+                del self.lanes[lane][client]
+            waiting = self._lane_jobs(lane)
+        for j in waiting:
+            notify_job(j)
+        return entry[0]
+
+    def release(self, job_id: str) -> bool:
+        """Give a running job's slot back right away, e.g. when the job is cancelled.
+
+        A replacement worker starts immediately; the old thread exits once the
+        cancelled job has unwound.
+        """
+        with self.cond:
+            token = self.running.pop(job_id, None)
+            if not token:
+                return False
+            token["retired"] = True
+            self.active -= 1
+        threading.Thread(target=self._worker, args=(token["audio_only"],), daemon=True).start()
+        return True
+
+    def has_capacity(self) -> bool:
+        """A newly queued job would start right away."""
+        with self.cond:
+            return self.active + len(self.queued) < self.workers
+
+    def position(self, job_id: str):
+        """(lane, 1-based position in that lane's round-robin order) for a queued job."""
+        with self.cond:
+            where = self.queued.get(job_id)
+            if not where:
+                return None
+            lane, client = where
+            clients = self.lanes[lane]
+            k = next(i for i, e in enumerate(clients[client]) if e[0].id == job_id)
+            ahead = k
+            before = True  # clients ahead of ours in the rotation get one extra turn
+            for c, q in clients.items():
+                if c == client:
+                    before = False
+                    continue
+                ahead += min(len(q), k + 1 if before else k)
+            return lane, ahead + 1
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "active": self.active,
+                "queued": len(self.queued),
+                "max_queued": self.max_queued,
+                "lanes": {lane: sum(len(q) for q in clients.values()) for lane, clients in self.lanes.items()},
+            }
+
+    def _lane_jobs(self, lane):
+        return [e[0] for q in self.lanes[lane].values() for e in q]
+
+    def _pop(self, audio_only: bool):
+        if audio_only:
+            order = ("audio",)
+        else:
+            # alternate lanes so neither can monopolise the shared workers
+            order = ("audio", "video") if self.last_lane == "video" else ("video", "audio")
+        for lane in order:
+            clients = self.lanes[lane]
+            if not clients:
+                continue
+            client, q = next(iter(clients.items()))
+            entry = q.popleft()
+            del clients[client]
+            if q:
+                clients[client] = q  # rotate: this client goes to the back of the lane
+            del self.queued[entry[0].id]
+            if not audio_only:
+                self.last_lane = lane
+            return lane, entry
+        return None, None
+
+    def _worker(self, audio_only: bool):
+        token = {"audio_only": audio_only, "retired": False}
+        while True:
+            with self.cond:
+                lane, entry = self._pop(audio_only)
+                while entry is None:
+                    self.cond.wait()
+                    lane, entry = self._pop(audio_only)
+                self.active += 1
+                self.running[entry[0].id] = token
+                waiting = self._lane_jobs(lane)
+            # everyone behind the dequeued job moved up one place
+            for j in waiting:
+                notify_job(j)
+            job, fn, args = entry
+            try:
+                fn(*args)
+            except Exception as e:
+                if DEBUG_LOG:
+                    print(f"[scheduler] job {job.id} crashed: {repr(e)}")
+            finally:
+                with self.cond:
+                    if token["retired"]:
+                        # slot was handed to a replacement worker by release()
+                        return
+                    self.running.pop(job.id, None)
+                    self.active -= 1
+
+SCHEDULER = Scheduler(MAX_CONCURRENT, AUDIO_RESERVED_SLOTS, MAX_QUEUED, MAX_QUEUED_PER_CLIENT)
+
+class ConnectionBudget:
+    """Upstream connections shared by all running downloads.
+
+    A job asking for several connections gets its fair share of what is
+    free: at most total // (holders + 1), so jobs starting later still find
+    some, and never less than one, so a download always proceeds.
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self.lock = threading.Lock()
+        self.used = 0
+        self.holders = 0
+
+    def acquire(self, want: int) -> int:
+        with self.lock:
+            n = max(1, min(want, self.total - self.used, self.total // (self.holders + 1)))
+            self.used += n
+            self.holders += 1
+            return n
+
+    def release(self, n: int):
+        with self.lock:
+            self.used -= n
+            self.holders -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"total": self.total, "used": self.used, "jobs": self.holders}
+
+CONNECTIONS = ConnectionBudget(MAX_CONNECTIONS)
+
+class IngressShaper:
+    """Split the global download bandwidth cap among the running downloads.
+
+    Each download registers its YoutubeDL params; yt-dlp reads
+    params["ratelimit"] for every chunk, so rewriting it retunes a running
+    download. Shares are max-min fair: a job getting well under its share
+    (slow upstream) is allotted what it uses plus headroom and the rest goes
+    to the jobs the cap is holding back. Rebalanced when a download starts
+    or ends and at most every REBALANCE_SECONDS while progress comes in.
+    """
+
+    REBALANCE_SECONDS = 1.0
+    FLOOR = 16 * 1024  # no download is starved below this
+
+    def __init__(self, total: int):
+        self.total = total
+        self.lock = threading.Lock()
+        self.jobs = {}  # job id -> [params, streams, speed]
+        self.balanced_at = 0.0
+
+    def attach(self, job_id: str, params: dict, streams: int = 1):
+        """Cap params for job_id; streams is how many downloaders each apply params["ratelimit"]."""
+        if not self.total:
+            return
+        with self.lock:
+            self.jobs[job_id] = [params, max(1, streams), 0]
+            self._rebalance()
+
+    def detach(self, job_id: str):
+        with self.lock:
+            if self.jobs.pop(job_id, None) is not None:
+                self._rebalance()
+
+    def report(self, job_id: str, speed):
+        if not self.total:
+            return
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            if entry is None:
+                return
+            entry[2] = speed or 0
+            if time.time() - self.balanced_at >= self.REBALANCE_SECONDS:
+                self._rebalance()
+
+    def allocation(self, job_id: str):
+        with self.lock:
+            entry = self.jobs.get(job_id)
+            return entry[0].get("ratelimit", 0) * entry[1] if entry else None
+
+    def _rebalance(self):
+        self.balanced_at = time.time()
+        if not self.jobs:
+            return
+        demand = {}
+        for job_id, (params, streams, speed) in self.jobs.items():
+            current = (params.get("ratelimit") or 0) * streams
+            # under 80% of its allotment: the job is limited elsewhere, give it what it uses + 25%
+            demand[job_id] = max(speed * 1.25, self.FLOOR) if current and 0 < speed < current * 0.8 else float("inf")
+        left, n = self.total, len(demand)
+        for job_id in sorted(demand, key=demand.get):
+            share = max(min(demand[job_id], left / n), self.FLOOR)
+            left -= share
+            n -= 1
+            params, streams, _ = self.jobs[job_id]
+            params["ratelimit"] = max(1, int(share) // streams)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "limit": self.total,
+                "allocations": {k: v[0].get("ratelimit", 0) * v[1] for k, v in self.jobs.items()},
+            }
+
+INGRESS = IngressShaper(INGRESS_LIMIT_BYTES)
+
+class TokenBucket:
+    """Refills at rate bytes/s up to burst; take() may run into debt and returns the seconds to wait."""
+
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def idle(self) -> bool:
+        return time.monotonic() - self.stamp > self.burst / self.rate + 60
+
+class EgressLimiter:
+    """One token bucket per client, shared by all of its /fetch transfers."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, client: str):
+        if not self.rate:
+            return None
+        with self.lock:
+            b = self.buckets.get(client)
+            if b is None:
+                for k in [k for k, v in self.buckets.items() if v.idle()]:
+                    del self.buckets[k]
+                b = self.buckets[client] = TokenBucket(self.rate, max(self.rate, 256 * 1024))
+            return b
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"per_client_limit": self.rate, "clients": len(self.buckets)}
+
+EGRESS = EgressLimiter(EGRESS_CLIENT_LIMIT_BYTES)
+_EXTERNAL_DL = which(EXTERNAL_DOWNLOADER) if EXTERNAL_DOWNLOADER else None
+
+_PEER_ADDRS = [0.0, set()]  # [resolved at, addresses of the cluster nodes]
+
+def _peer_addrs() -> set:
+    """Addresses the other cluster nodes connect from, resolved from their NODE_URLs every NODE_TIMEOUT."""
+    if time.time() - _PEER_ADDRS[0] >= NODE_TIMEOUT:
+        addrs = set()
+        for url, _ in list(getattr(JOB_STORE, "peers", {}).values()):
+            try:
+                addrs.update(a[4][0] for a in socket.getaddrinfo(urlsplit(url).hostname, None))
+            except (OSError, UnicodeError, ValueError):
+                pass
+        _PEER_ADDRS[:] = [time.time(), addrs]
+    return _PEER_ADDRS[1]
+
+def client_id() -> str:
+    """Identify the requesting client for fair queuing and per-client limits.
+
+    This is the peer address; ProxyFix takes it from X-Forwarded-For only
+    across the PROXY_HOPS proxies configured in front of the app, so a
+    client cannot pick a fresh identity by sending that header. A request
+    forwarded by another cluster node names its client in X-Hyper-Client,
+    which is believed only when it comes from a node's address.
+    """
+    addr = request.remote_addr or "unknown"
+    forwarded = request.headers.get("X-Hyper-Client")
+    if forwarded and CLUSTER_BACKEND:
+        direct = request.environ.get("werkzeug.proxy_fix.orig", {}).get("REMOTE_ADDR", addr)
+        if direct in _peer_addrs():
+            return forwarded
+    return addr
+
+PARTIAL_SUFFIXES = (".part", ".ytdl", ".temp")  # left behind by an interrupted yt-dlp / ffmpeg write
+
+def _find_output_file(tmpdir: Path, prefix_base: str):
+    """Find largest matching file that starts with prefix_base in tmpdir."""
+    # prefix may contain percent-templates if user used templates; but our outtmpl uses prefix_base + '__'
+    candidates = list(tmpdir.glob(f"{prefix_base}__*"))
+    # If postprocessor created mp3, extension may differ; include any extension.
+    if not candidates:
+        # fallback: all files
+        candidates = list(tmpdir.iterdir())
+    # pick largest regular file (never an unfinished one)
+    files = [p for p in candidates if p.is_file() and not p.name.endswith(PARTIAL_SUFFIXES)]
+    if not files:
+        return None
+    return max(files, key=lambda p: p.stat().st_size)
+
+def _run_yt_dlp_extract(job: Job, opts: dict, url: str, info: dict = None, pps=()):
+    """Run extraction and return True/False. Exceptions handled by caller.
+
+    When an already extracted info dict is given it is processed directly
+    (format selection + download) instead of extracting the URL again.
+    pps are extra postprocessor instances run after the configured ones.
+    """
+    with YoutubeDL(opts) as y:
+        for pp in pps:
+            y.add_post_processor(pp)
+        if info is not None:
+            y.process_ie_result(info, download=True)
+        else:
+            y.extract_info(url, download=True)
+    return True
+
+STREAMABLE_PROTOCOLS = ("http", "https")
+
+def _select_formats(opts: dict, info: dict) -> list:
+    """Run yt-dlp's format selection only; returns the formats a download of info would fetch."""
+    with YoutubeDL(dict(opts, progress_hooks=[], postprocessor_hooks=[])) as y:
+        processed = y.process_ie_result(copy.deepcopy(info), download=False)
+    return processed.get("requested_formats") or [processed]
+
+def _apply_connections(opts: dict, n: int, formats: list, hook, duration=None):
+    """Let one download use n upstream connections; returns a progress monitor to start, or None.
+
+    DASH/HLS formats fetch n fragments at once. Plain HTTP(S) formats go
+    through the external downloader (aria2c) split into n ranges; it reports
+    nothing to yt-dlp until it exits, so a _DiskProgress thread drives hook.
+    """
+    opts["concurrent_fragment_downloads"] = n
+    if not _EXTERNAL_DL:
+        return None
+    if not all(f.get("protocol", "https") in STREAMABLE_PROTOCOLS for f in formats):
+        # fragmented formats: yt-dlp's own downloader reports progress
+        return None
+    opts["external_downloader"] = {"http": _EXTERNAL_DL}
+    if os.path.basename(_EXTERNAL_DL).startswith("aria2c"):
+        opts["external_downloader_args"] = {"aria2c": ["-x", str(min(n, 16)), "-s", str(n), "-j", str(n)]}
+    return _DiskProgress(hook, sum(_format_size(f, duration) for f in formats))
+
+class _DiskProgress(threading.Thread):
+    """Feed the progress hook from the bytes landing in a job's tmp dir.
+
+    Allocated blocks are counted rather than file sizes, since a segmented
+    downloader writes its ranges into a sparse file.
+    """
+
+    def __init__(self, hook, total: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.hook = hook
+        self.total = total
+        self.interval = interval
+        self.tmp = None
+        self.done = threading.Event()
+
+    def watch(self, tmp: Path):
+        self.tmp = tmp
+        self.start()
+
+    def run(self):
+        started = time.time()
+        while not self.done.wait(self.interval):
+            size = 0
+            for p in self.tmp.iterdir():
+                try:
+                    if p.is_file() and p.suffix != ".aria2":
+                        st = p.stat()
+                        size += min(st.st_size, getattr(st, "st_blocks", 0) * 512 or st.st_size)
+                except OSError:
+                    pass
+            try:
+                self.hook({"status": "downloading", "downloaded_bytes": size,
+                           "total_bytes": max(self.total, size),
+                           "speed": size / max(time.time() - started, 0.001)})
+            except JobCancelled:
+                # cancel_job_now kills the downloader process; nothing left to report
+                return
+
+    def stop(self):
+        self.done.set()
+
+def _plan_delivery(opts: dict, info: dict):
+    """Decide how a "stream" job can be delivered while it downloads.
+
+    Returns (mode, processed info): "progressive" when the selected format is
+    a single file needing no postprocessing (yt-dlp writes it in place and
+    /fetch tails it), "fmp4" when a video+audio pair can be remuxed by ffmpeg
+    straight into a fragmented MP4, otherwise "file" (wait for completion).
+    """
+    if opts.get("postprocessors"):
+        return "file", None
+    with YoutubeDL(dict(opts, progress_hooks=[], postprocessor_hooks=[])) as y:
+        processed = y.process_ie_result(copy.deepcopy(info), download=False)
+    requested = processed.get("requested_formats")
+    if not requested:
+        return "progressive", processed
+    if (HAS_FFMPEG and len(requested) == 2
+            and all(f.get("protocol") in STREAMABLE_PROTOCOLS and f.get("url") for f in requested)):
+        return "fmp4", processed
+    return "file", None
+
+def _run_ffmpeg_remux(job: Job, processed: dict, out_path: str, hook):
+    """Remux the selected video+audio URLs into a fragmented MP4 that grows as it is written.
+
+    ffmpeg reads both streams directly; progress is reported through the
+    regular yt-dlp hook so cancellation and notifications behave the same.
+    """
+    formats = processed["requested_formats"]
+    total = sum(_format_size(f, processed.get("duration")) for f in formats)
+    cmd = [_FFMPEG, "-hide_banner", "-loglevel", "error", "-nostdin", "-y"]
+    for f in formats:
+        headers = "".join(f"{k}: {v}\r\n" for k, v in (f.get("http_headers") or {}).items())
+        if headers:
+            cmd += ["-headers", headers]
+        cmd += ["-i", f["url"]]
+    cmd += ["-map", "0:v:0", "-map", "1:a:0", "-c", "copy",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4", "-progress", "pipe:1", out_path]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    started = time.time()
+    try:
+        for line in proc.stdout:
+            if line.startswith("total_size="):
+                done = int(line.split("=", 1)[1].strip() or 0)
+                elapsed = max(time.time() - started, 0.001)
+                hook({"status": "downloading", "downloaded_bytes": done,
+                      "total_bytes": max(total, done), "speed": done / elapsed})
+    except BaseException:
+        # cancelled through the hook (or broken pipe): don't leave ffmpeg running
+        proc.kill()
+        raise
+    finally:
+        proc.wait()
+    if proc.returncode != 0:
+        raise Exception(f"ffmpeg remux failed ({proc.returncode}): {proc.stderr.read()[-300:]}")
+    hook({"status": "finished"})
+
+class ProgressTracker:
+    """Fold one download's yt-dlp hook calls into overall Progress snapshots.
+
+    A merged download fetches its requested formats one after the other and
+    yt-dlp's counters restart for each. Here every format is a part weighted
+    by its size (expected from the format list until yt-dlp reports it), and
+    each ffmpeg postprocessing step adds POSTPROCESS_SHARE of the download
+    size. Percent never goes backwards; speed is an EWMA of the byte rate
+    with a SPEED_TAU second time constant, updated once per snapshot.
+    Hook calls without a format (external downloader, ffmpeg remux) already
+    describe the whole download.
+    """
+
+    SPEED_TAU = 3.0
+    POSTPROCESS_SHARE = 0.05
+
+    def __init__(self):
+        self.sizes = {}  # part -> expected (then reported) bytes, 0 if unknown
+        self.done = {}  # part -> bytes downloaded
+        self.pp_steps = 0
+        self.pp_done = 0
+        self.percent = 0
+        self.speed = 0.0
+        self.sample = None  # (time, bytes) of the last snapshot
+        self.reported_speed = 0.0
+
+    def plan(self, formats, duration, pp_steps: int):
+        for i, f in enumerate(formats):
+            part = f.get("format_id") or str(i)
+            self.sizes[part] = _format_size(f, duration)
+            self.done[part] = 0
+        self.pp_steps = pp_steps
+
+    def update(self, d: dict):
+        part = (d.get("info_dict") or {}).get("format_id")
+        total = int(d.get("total_bytes") or d.get("total_bytes_estimate") or 0)
+        downloaded = int(d.get("downloaded_bytes") or 0)
+        if part is None:
+            if set(self.sizes) != {""}:
+                self.sizes, self.done = {"": 0}, {"": sum(self.done.values())}
+            part = ""
+        if d.get("status") == "finished":
+            downloaded = max(downloaded, total, self.done.get(part, 0))
+            total = downloaded
+        if total:
+            self.sizes[part] = total
+        else:
+            self.sizes.setdefault(part, 0)
+        self.done[part] = downloaded
+        self.reported_speed = d.get("speed") or self.reported_speed
+
+    def postprocessed(self):
+        self.pp_done += 1
+
+    def snapshot(self, now: float) -> Progress:
+        known = [n for n in self.sizes.values() if n]
+        fill = sum(known) / len(known) if known else 0
+        total = int(sum(n or max(fill, self.done[p]) for p, n in self.sizes.items()))
+        downloaded = min(sum(self.done.values()), total) if total else sum(self.done.values())
+        if total:
+            pp_weight = total * self.POSTPROCESS_SHARE * self.pp_steps
+            pp_part = pp_weight * min(self.pp_done, self.pp_steps) / self.pp_steps if self.pp_steps else 0
+            self.percent = max(self.percent, int(min(100, (downloaded + pp_part) * 100 / (total + pp_weight))))
+        if self.sample is None:
+            self.speed = float(self.reported_speed)
+        else:
+            dt = now - self.sample[0]
+            if dt > 0:
+                rate = max(0, downloaded - self.sample[1]) / dt
+                self.speed += (1 - math.exp(-dt / self.SPEED_TAU)) * (rate - self.speed)
+        self.sample = (now, downloaded)
+        eta = int((total - downloaded) / self.speed) if total > downloaded and self.speed > 1 else None
+        return Progress(self.percent, downloaded, total, round(self.speed, 1), eta)
+
+# ---------- Sidecars (subtitles, thumbnail, metadata) ----------
+SIDECAR_POOL = ThreadPoolExecutor(max_workers=SIDECAR_THREADS, thread_name_prefix="sidecar")
+
+def sidecar_options(d: dict, fmt_key: str):
+    """Embedding options of a /start request, or None when there is nothing to embed.
+
+    "subtitles" is true (English), "en,de" or a list of languages;
+    "thumbnail" and "metadata" are booleans. Embedding needs ffmpeg, and
+    subtitles only go into video files.
+    """
+    if not HAS_FFMPEG:
+        return None
+    subs = d.get("subtitles")
+    if subs is True:
+        langs = ["en"]
+    elif isinstance(subs, str):
+        langs = subs.split(",")
+    elif isinstance(subs, list):
+        langs = [str(x) for x in subs]
+    else:
+        langs = []
+    langs = sorted({x.strip() for x in langs if x.strip()})[:8]
+    out = {
+        "subtitles": [] if is_audio(fmt_key) else langs,
+        "thumbnail": bool(d.get("thumbnail")),
+        "metadata": bool(d.get("metadata")),
+    }
+    return out if any(out.values()) else None
+
+def _fetch_sidecar(info: dict, out_dir: Path, fmt: str, params: dict, fields, stop: threading.Event) -> dict:
+    """Write one sidecar (subtitles or thumbnail) of info without downloading the media.
+
+    Returns the info fields yt-dlp filled in, whose entries now carry the
+    "filepath" of the written files. Setting stop aborts the transfer.
+    """
+    def hook(d):
+        if stop.is_set():
+            raise JobCancelled()
+
+    if stop.is_set():
+        return {}
+    opts = dict(EXTRACT_OPTS, format=fmt, skip_download=True, outtmpl=str(out_dir / "%(id)s.%(ext)s"),
+                progress_hooks=[hook], **params)
+    with YoutubeDL(opts) as y:
+        done = y.process_ie_result(copy.deepcopy(info), download=True)
+    return {k: done[k] for k in fields if done.get(k)}
+
+def start_sidecars(job: Job, info: dict, fmt: str, sidecars: dict, stop: threading.Event) -> list:
+    """Fetch subtitles and thumbnail in SIDECAR_POOL while the main download runs."""
+    out_dir = job.tmp / "sidecars"  # kept apart from the media, which _find_output_file picks from job.tmp
+    out_dir.mkdir(exist_ok=True)
+    futures = []
+    if sidecars["subtitles"]:
+        params = {"writesubtitles": True, "writeautomaticsub": True, "subtitleslangs": sidecars["subtitles"],
+                  "subtitlesformat": "srt/vtt/best"}
+        futures.append(SIDECAR_POOL.submit(_fetch_sidecar, info, out_dir, fmt, params, ("requested_subtitles",),
+                                           stop))
+    if sidecars["thumbnail"]:
+        futures.append(SIDECAR_POOL.submit(_fetch_sidecar, info, out_dir, fmt, {"writethumbnail": True},
+                                           ("thumbnails",), stop))
+    return futures
+
+def sidecar_steps(sidecars) -> int:
+    """ffmpeg postprocess runs the sidecars add to a job (for ProgressTracker.plan)."""
+    if not sidecars:
+        return 0
+    return bool(sidecars["subtitles"]) + sidecars["thumbnail"] + sidecars["metadata"]
+
+def _sidecar_pp(job: Job, sidecars: dict, futures: list):
+    """yt-dlp postprocessor that joins the sidecar fetches and embeds their results.
+
+    It runs last, on the final (merged / converted) file: subtitles, then
+    tags and chapters, then cover art. A sidecar that failed or timed out is
+    skipped; the job still finishes with the plain media file.
+    """
+    ytdlp = _yt_dlp()
+    pps = ytdlp.postprocessor
+
+    class SidecarPP(pps.PostProcessor):
+        def run(self, info):
+            deadline = time.time() + SIDECAR_WAIT_SECONDS
+            for fut in futures:
+                try:
+                    info.update(fut.result(timeout=max(0.0, deadline - time.time())))
+                except Exception as e:
+                    if DEBUG_LOG:
+                        print(f"[DEBUG] job {job.id} sidecar skipped: {e!r}")
+            embeds = []
+            if sidecars["subtitles"] and info.get("requested_subtitles"):
+                embeds.append(pps.FFmpegEmbedSubtitlePP(self._downloader))
+            if sidecars["metadata"]:
+                embeds.append(pps.FFmpegMetadataPP(self._downloader, add_infojson=False))
+            if sidecars["thumbnail"] and any(t.get("filepath") for t in info.get("thumbnails") or ()):
+                embeds.append(pps.EmbedThumbnailPP(self._downloader))
+            for pp in embeds:
+                if job.cancel_requested:
+                    raise JobCancelled()
+                try:
+                    _, info = pp.run(info)
+                except JobCancelled:
+                    raise
+                except Exception as e:
+                    # e.g. cover art for a container ffmpeg can't tag: keep the file as is
+                    if DEBUG_LOG:
+                        print(f"[DEBUG] job {job.id} {pp.pp_key()} failed: {e!r}")
+            return [], info
+
+    return SidecarPP()
+
+# ---------- Clips (time ranges) ----------
+_FFPROBE = which("ffprobe") or (str(Path(_FFMPEG).with_name("ffprobe")) if _FFMPEG else None)
+
+def parse_timestamp(value):
+    """Seconds from 95, 95.5, "95", "1:35" or "01:01:35.5"; None when empty. Raises ValueError."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    if isinstance(value, (int, float)):
+        secs = float(value)
+    else:
+        parts = str(value).strip().split(":")
+        try:
+            if len(parts) > 3:
+                raise ValueError
+            secs = 0.0
+            for part in parts:
+                secs = secs * 60 + float(part)
+        except ValueError:
+            raise ValueError(f"Invalid timestamp: {value!r}") from None
+    if not math.isfinite(secs) or secs < 0:
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    return round(secs, 3)
+
+def clip_options(d: dict):
+    """Time range of a /start request, or None for the whole video. Raises ValueError.
+
+    "start" / "end" are timestamps (either may be left out); "clip_mode" is
+    "copy" (cut on keyframes, no re-encode), "precise" (re-encode around
+    the cuts) or "auto" (copy when the start cut lands on a keyframe).
+    """
+    start = parse_timestamp(d.get("start")) or 0.0
+    end = parse_timestamp(d.get("end"))
+    if not start and end is None:
+        return None
+    if end is not None and end <= start:
+        raise ValueError("end must be after start")
+    mode = d.get("clip_mode") or "auto"
+    if mode not in ("auto", "copy", "precise"):
+        raise ValueError("clip_mode must be auto, copy or precise")
+    if not HAS_FFMPEG:
+        raise ValueError("Clips need ffmpeg on the server")
+    return {"start": start, "end": end, "mode": mode}
+
+class ClipOutOfRange(Exception):
+    """A requested clip does not fit the video (known once it is extracted)."""
+
+def clip_range(clip: dict, duration):
+    """(start, end) seconds of the clip within a video of the given duration (None = unknown)."""
+    start, end = clip["start"], clip["end"]
+    if duration:
+        if start >= duration:
+            raise ClipOutOfRange(f"Clip start {start:g}s is past the end of the video ({duration:g}s)")
+        end = min(end or duration, duration)
+    elif end is None:
+        raise ClipOutOfRange("The video's length is unknown: the clip needs an end time")
+    return start, end
+
+def _keyframe_at(fmt: dict, t: float) -> bool:
+    """True when the format's video has a keyframe within CLIP_KEYFRAME_TOLERANCE of t.
+
+    ffprobe seeks the remote file and decodes only the keyframes around t,
+    which costs a few range requests, not a download.
+    """
+    tol = CLIP_KEYFRAME_TOLERANCE
+    cmd = [_FFPROBE, "-v", "error", "-select_streams", "v:0", "-skip_frame", "nokey",
+           "-read_intervals", f"{max(0.0, t - tol)}%+{2 * tol}",
+           "-show_entries", "frame=best_effort_timestamp_time", "-of", "csv=p=0"]
+    headers = "".join(f"{k}: {v}\r\n" for k, v in (fmt.get("http_headers") or {}).items())
+    if headers:
+        cmd += ["-headers", headers]
+    cmd.append(fmt["url"])
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, timeout=CLIP_PROBE_TIMEOUT).stdout
+    except (OSError, subprocess.SubprocessError):
+        return False
+    for line in out.split():
+        try:
+            if abs(float(line.strip(",")) - t) <= tol:
+                return True
+        except ValueError:
+            pass
+    return False
+
+def clip_precise(clip: dict, formats: list) -> bool:
+    """Whether the clip is re-encoded at its cuts (force_keyframes_at_cuts) instead of stream-copied.
+
+    A stream copy can only start on a keyframe, so "auto" copies when the
+    video has one at the start cut; audio can be cut anywhere. The end cut
+    of a copy is exact either way.
+    """
+    if clip["mode"] != "auto":
+        return clip["mode"] == "precise"
+    videos = [f for f in formats if f.get("vcodec") not in (None, "none")]
+    if not videos or not clip["start"]:
+        return False
+    f = videos[0]
+    if not _FFPROBE or f.get("protocol") not in STREAMABLE_PROTOCOLS or not f.get("url"):
+        return True
+    return not _keyframe_at(f, clip["start"])
+
+def run_download(job: Job, url: str, fmt_key: str, filename: str = None, video_res=None, audio_bitrate=None,
+                 delivery: str = "file", sidecars=None, clip=None):
+    """Optimized run_download: strict audio format, safe filename, postprocessors, limited logging.
+
+    delivery="stream" lets /fetch start sending bytes before the job finishes
+    when the selected formats allow it (see _plan_delivery); job.delivery_mode
+    records what was actually used. sidecars (see sidecar_options) are
+    fetched alongside the download and embedded at the end. A clip (see
+    clip_options) downloads only that time range.
+    """
+    # phase timestamps for METRICS; "phase" names the step an error is charged to
+    t = {"start": time.time(), "dl_start": None, "pp_start": None, "bytes": 0, "phase": "extract"}
+    t["conns"], t["transcoding"] = 0, False
+    monitor = None
+    side_futures, side_stop = [], threading.Event()
+    METRICS.observe("hyper_phase_seconds", max(0.0, t["start"] - job.created_at), phase="queue")
+    try:
+        if not URL_RE.match(url):
+            job.status = "error"
+            job.error = "Invalid URL"
+            METRICS.inc("hyper_errors_total", category="invalid_url")
+            return
+
+        # normalize inputs
+        try:
+            vres = int(video_res) if video_res else None
+        except Exception:
+            vres = None
+        try:
+            abitrate = int(audio_bitrate) if audio_bitrate else None
+        except Exception:
+            abitrate = None
+
+        # Format selection
+        if is_audio(fmt_key):
+            fmt = AUDIO_FORMATS[fmt_key][0]
+        else:
+            fmt = _build_video_format(vres)
+
+        # progress hook: yt-dlp's callbacks feed the tracker, whose snapshot is published
+        # at most once per PROGRESS_MIN_INTERVAL so fast downloads don't flood streams
+        tracker = ProgressTracker()
+        last_notify = [0.0]
+        def hook(d):
+            if job.cancel_requested:
+                # raising out of the hook aborts the transfer inside yt-dlp
+                raise JobCancelled()
+            try:
+                st = d.get("status")
+                if st == "downloading":
+                    first = job.status != "downloading"
+                    if t["dl_start"] is None:
+                        t["dl_start"] = time.time()
+                        t["phase"] = "download"
+                    job.status = "downloading"
+                    if job.delivery_mode == "progressive" and not job.stream_path and d.get("filename"):
+                        # nopart: yt-dlp writes straight to the final name, which /fetch tails
+                        job.stream_path = d.get("tmpfilename") or d["filename"]
+                    tracker.update(d)
+                    INGRESS.report(job.id, d.get("speed"))
+                    now = time.time()
+                    if first or now - last_notify[0] >= PROGRESS_MIN_INTERVAL:
+                        last_notify[0] = now
+                        job.progress = tracker.snapshot(now)
+                        notify_job(job)
+                elif st == "finished":
+                    t["bytes"] += int(d.get("total_bytes") or d.get("downloaded_bytes") or 0)
+                    tracker.update(d)
+                    job.progress = tracker.snapshot(time.time())
+                    notify_job(job)
+            except Exception:
+                # swallow hook errors to avoid crashing yt-dlp
+                pass
+
+        def pp_hook(d):
+            if job.cancel_requested:
+                raise JobCancelled()
+            if d.get("status") == "started" and t["pp_start"] is None:
+                t["pp_start"] = time.time()
+                t["phase"] = "postprocess"
+            if d.get("status") == "started" and not t["transcoding"] and d.get("postprocessor") in FFMPEG_PPS:
+                _enter_transcode(job, t)
+            if d.get("status") == "finished" and d.get("postprocessor") in FFMPEG_PPS:
+                tracker.postprocessed()
+                job.progress = tracker.snapshot(time.time())
+                notify_job(job)
+
+        # filename handling (preserve template tokens if provided)
+        base_template = (filename.strip() if filename else "%(title)s").rstrip(".")
+        if "%(" in base_template and ")" in base_template:
+            # keep template tokens, sanitize outside tokens
+            def _replace_outside_tokens(s):
+                out = []
+                i = 0
+                while i < len(s):
+                    if s[i] == '%' and i+1 < len(s) and s[i+1] == '(':
+                        j = i+2
+                        while j < len(s) and s[j] != ')':
+                            j += 1
+                        if j < len(s):
+                            out.append(s[i:j+1])
+                            i = j+1
+                            continue
+                        else:
+                            out.append(s[i:])
+                            break
+                    else:
+                        out.append(s[i])
+                        i += 1
+                joined = "".join(out)
+                return _FILENAME_SANITIZE_RE.sub("_", joined)
+            safe_base = _replace_outside_tokens(base_template)
+        else:
+            safe_base = sanitize_filename(base_template)
+
+        prefix_safe = _FILENAME_SANITIZE_RE.sub("_", APP_PREFIX.strip() or "Hyper_Downloader")
+        outtmpl_base = f"{prefix_safe}__{safe_base}"
+        outtmpl = str(job.tmp.joinpath(outtmpl_base + ".%(ext)s"))
+
+        opts = dict(EXTRACT_OPTS)
+        opts.update({
+            "format": fmt,
+            "outtmpl": outtmpl,
+            "progress_hooks": [hook],
+            "postprocessor_hooks": [pp_hook],
+            "retries": 5,
+            "fragment_retries": 5,
+        })
+
+        if DEBUG_LOG:
+            opts["verbose"] = True
+
+        # Audio postprocessing is decided once the format is selected (see _audio_postprocessors)
+        if is_audio(fmt_key):
+            pass  # Important: do NOT set merge_output_format for audio
+        else:
+            if HAS_FFMPEG:
+                opts["ffmpeg_location"] = _FFMPEG
+                # set merge only for video 
+                try:
+                    if vres and int(vres) <= 1080:
+                        opts["merge_output_format"] = "mp4"
+                    else:
+                        opts["merge_output_format"] = "mp4"
+                except Exception:
+                    opts["merge_output_format"] = "mp4"
+
+        # run yt-dlp inside try-except
+        try:
+            if DEBUG_LOG:
                 print(f"[DEBUG] Starting download job {job.id} fmt={fmt} outtmpl={outtmpl} url={url}")
-            _run_yt_dlp_extract(job, opts, url)
+            # reuse the preview's info dict (or coalesce with a concurrent /info) instead of re-extracting
+            info = INFO_CACHE.get_or_extract(url)
+            METRICS.observe("hyper_phase_seconds", time.time() - t["start"], phase="extract")
+            t["phase"] = "download"
+            plan = plan_formats(info.get("formats"), fmt_key, vres, info.get("duration"), HAS_FFMPEG)
+            if plan:
+                opts["format"] = plan["format"]
+                if DEBUG_LOG:
+                    print(f"[DEBUG] job {job.id} format plan: {plan}")
+            formats = _select_formats(opts, info)
+            if is_audio(fmt_key):
+                # stream-copy fast path: no ffmpeg at all when the source already is the target
+                pps = _audio_postprocessors(AUDIO_FORMATS[fmt_key][1], formats, abitrate)
+                if pps:
+                    opts["postprocessors"] = pps
+            pp_steps = (len(formats) > 1) + sum(1 for pp in opts.get("postprocessors", ())
+                                               if pp["key"].replace("FFmpeg", "", 1) in FFMPEG_PPS)
+            pp_steps += sidecar_steps(sidecars)
+            sized = formats
+            if clip:
+                # ffmpeg seeks into the source and fetches (and merges) only the range in one run
+                duration = info.get("duration")
+                start, end = clip_range(clip, duration)
+                opts["download_ranges"] = _yt_dlp().utils.download_range_func(None, [(start, end)])
+                opts["force_keyframes_at_cuts"] = clip_precise(clip, formats)
+                share = (end - start) / duration if duration else 1.0
+                sized = [{"format_id": "+".join(f.get("format_id", "") for f in formats),
+                          "filesize": int(sum(_format_size(f, duration) for f in formats) * share)}]
+                pp_steps -= len(formats) > 1
+                if DEBUG_LOG:
+                    print(f"[DEBUG] job {job.id} clip {start}-{end} precise={opts['force_keyframes_at_cuts']}")
+            tracker.plan(sized, info.get("duration"), pp_steps)
+            processed = None
+            job.delivery_mode = "file"
+            if delivery == "stream":
+                job.delivery_mode, processed = _plan_delivery(opts, info)
+                notify_job(job)
+            STORAGE.admit(job, _estimate_bytes(sized, opts, info.get("duration")))
+            if sidecars:
+                side_futures = start_sidecars(job, info, opts["format"], sidecars, side_stop)
+            if job.delivery_mode == "fmp4":
+                with YoutubeDL(opts) as y:
+                    out_path = str(Path(y.prepare_filename(processed)).with_suffix(".mp4"))
+                job.stream_path = out_path
+                _run_ffmpeg_remux(job, processed, out_path, hook)
+            else:
+                if job.delivery_mode == "progressive":
+                    opts["nopart"] = True
+                if JOB_CONNECTIONS > 1 and not clip:
+                    conns = t["conns"] = CONNECTIONS.acquire(JOB_CONNECTIONS)
+                    if conns > 1 and job.delivery_mode == "file":
+                        monitor = _apply_connections(opts, conns, formats, hook, info.get("duration"))
+                        if monitor:
+                            monitor.watch(job.tmp)
+                    elif conns > 1:
+                        # progressive: /fetch tails the file as written, so no external downloader
+                        opts["concurrent_fragment_downloads"] = conns
+                # aria2c applies ratelimit as an overall cap; fragment downloaders each apply it
+                INGRESS.attach(job.id, opts, 1 if opts.get("external_downloader")
+                               else opts.get("concurrent_fragment_downloads", 1))
+                _run_yt_dlp_extract(job, opts, url, info,
+                                    [_sidecar_pp(job, sidecars, side_futures)] if sidecars else ())
+            if job.cancel_requested:
+                raise JobCancelled()
+            _observe_transfer(t)
         except Exception as e:
+            if job.cancel_requested:
+                job.status = "error"
+                job.error = "Cancelled"
+                METRICS.inc("hyper_errors_total", category="cancelled")
+                return
             job.status = "error"
+            if isinstance(e, StorageFull):
+                job.error = str(e)
+                METRICS.inc("hyper_errors_total", category="storage")
+                return
+            if isinstance(e, ClipOutOfRange):
+                job.error = str(e)
+                METRICS.inc("hyper_errors_total", category="invalid_clip")
+                return
             job.error = f"yt-dlp failed: {str(e)[:400]}"
+            METRICS.inc("hyper_errors_total", category=t["phase"])
             if DEBUG_LOG:
                 print(f"[ERROR] job {job.id} yt-dlp exception: {repr(e)}")
             return
 
         # pick resulting file only from our tmp dir and matching prefix
+        t_find = time.perf_counter()
         found = _find_output_file(job.tmp, prefix_safe)
-        if found:
-            job.file = str(found)
-            job.status = "finished"
-            if DEBUG_LOG:
-                print(f"[DEBUG] job {job.id} finished file={job.file}")
-        else:
+        METRICS.observe("hyper_phase_seconds", time.perf_counter() - t_find, phase="find_output")
+        if not found:
             # fallback: check any file in tmp
             files = list(job.tmp.glob("*"))
             files = [p for p in files if p.is_file()]
             if files:
-                job.file = str(max(files, key=lambda p: p.stat().st_size))
-                job.status = "finished"
+                found = max(files, key=lambda p: p.stat().st_size)
                 if DEBUG_LOG:
-                    print(f"[DEBUG] job {job.id} fallback file={job.file}")
-            else:
-                job.status = "error"
-                job.error = "No output file produced"
-                if DEBUG_LOG:
-                    print(f"[ERROR] job {job.id} - no output file found in {job.tmp}")
+                    print(f"[DEBUG] job {job.id} fallback file={found}")
+        if found:
+            # move into the shared result cache so identical requests reuse it
+            job.file = ARTIFACTS.publish(job.artifact, found) if job.artifact else str(found)
+            job.complete_progress()
+            job.status = "finished"
+            if DEBUG_LOG:
+                print(f"[DEBUG] job {job.id} finished file={job.file}")
+        else:
+            job.status = "error"
+            job.error = "No output file produced"
+            METRICS.inc("hyper_errors_total", category="no_output")
+            if DEBUG_LOG:
+                print(f"[ERROR] job {job.id} - no output file found in {job.tmp}")
 
     except Exception as e:
         job.status = "error"
         job.error = str(e)[:400]
+        METRICS.inc("hyper_errors_total", category="unexpected")
         if DEBUG_LOG:
             print(f"[ERROR] run_download unexpected: {repr(e)}")
+    finally:
+        if side_futures:
+            # a failed or cancelled run: stop the sidecars before the temp dir can go
+            side_stop.set()
+            futures_wait(side_futures)
+        STORAGE.release(job.id)
+        INGRESS.detach(job.id)
+        if monitor:
+            monitor.stop()
+        if t["conns"]:
+            CONNECTIONS.release(t["conns"])
+        if t["transcoding"]:
+            TRANSCODES.release()
+        METRICS.inc("hyper_jobs_total", outcome="finished" if job.status == "finished" else "error")
+        if job.cancel_requested:
+            shutil.rmtree(str(job.tmp), ignore_errors=True)
+        if job.artifact:
+            _settle_followers(job)
+        if job.detached:
+            # its own client cancelled while others waited on the file: they have it now
+            if job.file:
+                ARTIFACTS.release(job.artifact)
+                job.file = None
+            job.status = "error"
+            job.error = "Cancelled"
+            shutil.rmtree(str(job.tmp), ignore_errors=True)
+        notify_job(job)
+
+class TranscodePool:
+    """Slots for CPU-bound ffmpeg postprocessing, sized to the CPU count independently of MAX_CONCURRENT."""
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self.cond = threading.Condition()
+        self.busy = 0
+        self.waiting = 0
+
+    def acquire(self, timeout: float) -> bool:
+        with self.cond:
+            self.waiting += 1
+            ok = self.cond.wait_for(lambda: self.busy < self.slots, timeout)
+            self.waiting -= 1
+            if ok:
+                self.busy += 1
+            return ok
+
+    def release(self):
+        with self.cond:
+            self.busy -= 1
+            self.cond.notify()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {"slots": self.slots, "busy": self.busy, "waiting": self.waiting}
+
+TRANSCODES = TranscodePool(TRANSCODE_SLOTS)
+FFMPEG_PPS = ("Merger", "ExtractAudio", "VideoConvertor", "VideoRemuxer",  # postprocessors that run ffmpeg on the file
+              "EmbedSubtitle", "Metadata", "EmbedThumbnail")
+
+def _enter_transcode(job: Job, t: dict):
+    """Move a job from its download slot to a transcode slot once the network part is done.
+
+    The scheduler slot, upstream connections and bandwidth share go to the
+    next downloads right away; the job's thread then waits for a free
+    transcode slot.
+    """
+    SCHEDULER.release(job.id)
+    INGRESS.detach(job.id)
+    if t["conns"]:
+        CONNECTIONS.release(t["conns"])
+        t["conns"] = 0
+    while not TRANSCODES.acquire(timeout=1.0):
+        if job.cancel_requested:
+            raise JobCancelled()
+    t["transcoding"] = True
+
+def _observe_transfer(t: dict):
+    """Record download / postprocess durations, bytes and throughput of a finished run."""
+    end = time.time()
+    dl_start = t["dl_start"] or end
+    dl_end = t["pp_start"] or end
+    METRICS.observe("hyper_phase_seconds", max(0.0, dl_end - dl_start), phase="download")
+    if t["pp_start"]:
+        METRICS.observe("hyper_phase_seconds", end - t["pp_start"], phase="postprocess")
+    if t["bytes"]:
+        METRICS.inc("hyper_download_bytes_total", t["bytes"])
+        if dl_end > dl_start:
+            METRICS.observe("hyper_job_throughput_bytes_per_second", t["bytes"] / (dl_end - dl_start))
+
+def _settle_followers(job: Job):
+    """Hand the producer's result (or error) to the jobs that attached to it."""
+    for fid, filename in ARTIFACTS.unclaim(job.artifact, job.id):
+        f = JOBS.get(fid)
+        if not f or f.status != "queued":
+            # gone, or cancelled while waiting
+            continue
+        path = ARTIFACTS.acquire(job.artifact) if job.status == "finished" else None
+        if path:
+            f.file = path
+            f.download_name = _download_name(filename, path)
+            f.complete_progress(path)
+            f.status = "finished"
+        else:
+            f.status = "error"
+            f.error = job.error or "Download failed"
+        notify_job(f)
+
+def _finish_cached(job: Job, filename, path: str):
+    job.file = path
+    job.download_name = _download_name(filename, path)
+    job.complete_progress(path)
+    job.status = "finished"
+    job.delivery_mode = "file"
+    notify_job(job)
+
+def enqueue_download(job: Job, client: str, url: str, fmt_key: str, filename=None, video_res=None,
+                     audio_bitrate=None, delivery: str = "file", sidecars=None, clip=None) -> str:
+    """Route a new job: serve it from the result cache, attach it to an identical
+    running job, or queue it for the scheduler.
+
+    Returns "cached", "attached", "queued" or "busy" (queue full; job dropped).
+    """
+    if sidecars or clip:
+        delivery = "file"  # embedding / cutting rewrites the finished file, nothing to stream early
+    job.delivery_mode = None if delivery == "stream" else "file"
+    if URL_RE.match(url):
+        digest = ArtifactStore.digest(artifact_key(url, fmt_key, video_res, audio_bitrate, delivery, sidecars, clip))
+        job.artifact = digest
+        # identical download already finished: serve it without running yt-dlp
+        path = ARTIFACTS.lookup(digest)
+        if path:
+            _finish_cached(job, filename, path)
+            return "cached"
+        # identical download in flight: wait for it instead of starting a second one
+        # (not across nodes: followers are settled by the process running the leader)
+        leader = None if CLUSTER_BACKEND else ARTIFACTS.claim(digest, job.id, filename)
+        if leader:
+            job.leader = leader
+            JOB_STORE.save(job)
+            return "attached"
+    if CLUSTER_BACKEND:
+        # any worker node may run it
+        queued = cluster_submit(job, client, job_lane(fmt_key),
+                                [url, fmt_key, filename, video_res, audio_bitrate, delivery, sidecars, clip])
+    else:
+        # queue for the scheduler (respects MAX_CONCURRENT and per-client fairness)
+        queued = SCHEDULER.submit(
+            job,
+            client,
+            job_lane(fmt_key),
+            run_download,
+            job,
+            url,
+            fmt_key,
+            filename,
+            video_res,
+            audio_bitrate,
+            delivery,
+            sidecars,
+            clip,
+        )
+    if not queued:
+        _drop_job(job, "Server busy")
+        JOB_STORE.remove(job.id)
+        return "busy"
+    return "queued"
+
+def cluster_submit(job: Job, client: str, lane: str, args: list) -> bool:
+    """Put a job in the shared queue for whichever worker node is free; False when it is full."""
+    if sum(JOB_STORE.backend.depth().values()) >= MAX_QUEUED:
+        return False
+    JOB_STORE.hand_off(job)
+    JOB_STORE.backend.push(lane, job.id, json.dumps({"job_id": job.id, "client": client, "lane": lane, "args": args}))
+    return True
+
+def _adopt(item: dict):
+    """Run a job pulled from the shared queue on this node."""
+    d = JOB_STORE._read(item["job_id"])
+    if not d or d["status"] != "queued" or d.get("cancel_requested"):
+        return  # cancelled or expired while queued
+    fmt_key, filename = item["args"][1], item["args"][2]
+    job = Job.from_dict(d)
+    job.local = True
+    job.node = NODE_ID
+    job.tmp = Job.make_tmp(STORAGE.dir_for(fmt_key))
+    JOB_STORE.adopt(job)
+    path = ARTIFACTS.lookup(job.artifact) if job.artifact else None
+    if path:
+        _finish_cached(job, filename, path)
+    elif not SCHEDULER.submit(job, item["client"], item["lane"], run_download, job, *item["args"]):
+        # lost the free slot to a local request: back into the shared queue
+        JOB_STORE.hand_off(job)
+        JOB_STORE.backend.push(item["lane"], job.id, json.dumps(item))
+
+def cluster_puller():
+    """Worker nodes: move jobs from the shared queue to the local scheduler whenever it has a free slot."""
+    while True:
+        try:
+            if not SCHEDULER.has_capacity():
+                time.sleep(0.2)
+                continue
+            item = JOB_STORE.backend.pop(Scheduler.LANES, 5.0)
+            if item:
+                _adopt(json.loads(item))
+        except Exception as e:
+            if DEBUG_LOG:
+                print("[cluster] pull error:", repr(e))
+            time.sleep(1.0)
 
 @app.post("/start")
 def start():
     d = request.json or {}
-    job = Job()
-    # submit to executor (respect MAX_CONCURRENT)
-    future = executor.submit(
-        run_download,
+    # reject before a job (and its temp dir) exists
+    if not isinstance(d, dict):
+        METRICS.inc("hyper_errors_total", category="invalid_request")
+        return jsonify({"error": "Expected a JSON object"}), 400
+    url = d.get("url", "")
+    if not isinstance(url, str) or not URL_RE.match(url):
+        METRICS.inc("hyper_errors_total", category="invalid_url")
+        return jsonify({"error": "Invalid URL"}), 400
+    if not isinstance(d.get("format_choice", "video"), str) or not isinstance(d.get("filename") or "", str):
+        METRICS.inc("hyper_errors_total", category="invalid_request")
+        return jsonify({"error": "format_choice and filename must be strings"}), 400
+    if not registry_has_room():
+        METRICS.inc("hyper_errors_total", category="busy")
+        return jsonify({"error": "Too many jobs, try again shortly"}), 503, {"Retry-After": "30"}
+    try:
+        clip = clip_options(d)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    job = Job(STORAGE.dir_for(d.get("format_choice", "video")))
+    result = enqueue_download(
         job,
-        d.get("url", ""),
+        client_id(),
+        url,
         d.get("format_choice", "video"),
         d.get("filename"),
         d.get("video_res"),
         d.get("audio_bitrate"),
+        "stream" if d.get("delivery") == "stream" else "file",
+        sidecar_options(d, d.get("format_choice", "video")),
+        clip,
     )
+    if result == "busy":
+        METRICS.inc("hyper_errors_total", category="busy")
+        return jsonify({"error": "Too many queued downloads, try again shortly"}), 429, {"Retry-After": "30"}
+    resp = {"job_id": job.id}
+    if result in ("cached", "attached"):
+        resp[result] = True
     # no blocking — return job id
-    return jsonify({"job_id": job.id})
+    return jsonify(resp)
+
+# ---------- Batch / playlist jobs ----------
+def _batch_entries(urls, playlist_url):
+    """Items of a batch: the given URLs, or one flat extraction of the playlist."""
+    if urls:
+        return [{"url": u, "title": ""} for u in urls if isinstance(u, str) and URL_RE.match(u)][:MAX_BATCH_ITEMS]
+    opts = dict(EXTRACT_OPTS, skip_download=True, extract_flat="in_playlist", noplaylist=False,
+                playlistend=MAX_BATCH_ITEMS)
+    with YoutubeDL(opts) as y:
+        info = y.extract_info(playlist_url, download=False)
+    entries = info.get("entries") or [info]
+    out = []
+    for e in entries:
+        url = e.get("webpage_url") or e.get("url") or ""
+        if URL_RE.match(url):
+            out.append({"url": url, "title": e.get("title") or ""})
+    return out[:MAX_BATCH_ITEMS]
+
+def run_batch(batch: Job, client: str, urls, playlist_url, fmt_key, video_res=None, audio_bitrate=None):
+    """Fan a batch out over child jobs, at most BATCH_PARALLEL at a time.
+
+    Children are ordinary jobs (result cache, attachment and scheduler
+    fairness apply); an item failing only marks that item as failed.
+    """
+    children = []
+    try:
+        entries = _batch_entries(urls, playlist_url)
+        if not entries:
+            batch.status = "error"
+            batch.error = "No downloadable items found"
+            return
+        batch.items = [{"job_id": None, "title": e["title"], "url": e["url"]} for e in entries]
+        batch.status = "downloading"
+        notify_job(batch)
+        pending = deque(range(len(entries)))
+        running = []
+        while pending or running:
+            if batch.cancel_requested:
+                for child in running:
+                    if child.local:
+                        cancel_job_now(child)
+                    else:
+                        request_cancel(child)
+                batch.status = "error"
+                batch.error = "Cancelled"
+                return
+            while pending and len(running) < BATCH_PARALLEL:
+                i = pending[0]
+                if not registry_has_room():
+                    break  # registry full of live jobs: retry on the next round
+                child = Job(STORAGE.dir_for(fmt_key))
+                if enqueue_download(child, client, entries[i]["url"], fmt_key, None, video_res, audio_bitrate) == "busy":
+                    break  # scheduler queue full: retry on the next round
+                pending.popleft()
+                batch.items[i]["job_id"] = child.id
+                children.append(child)
+                running.append(child)
+            time.sleep(0.5)
+            # re-read: in cluster mode children run on other nodes
+            children = [JOB_STORE.get(c.id) or c for c in children]
+            running = [JOB_STORE.get(c.id) or c for c in running]
+            for child in running:
+                # children are watched through the batch, not polled directly
+                if child.local:
+                    child.last_seen = max(child.last_seen, batch.last_seen)
+                elif batch.last_seen > child.last_seen:
+                    JOB_STORE.touch(child)
+            running = [c for c in running if c.status not in TERMINAL_STATUSES]
+            _aggregate_batch(batch, children)
+            notify_job(batch)
+        ok = [c for c in children if c.status in ("finished", "downloaded") and c.file]
+        if ok:
+            batch.complete_progress()
+            batch.status = "finished"
+        else:
+            batch.status = "error"
+            batch.error = "All items failed"
+    except Exception as e:
+        batch.status = "error"
+        batch.error = str(e)[:400]
+        if DEBUG_LOG:
+            print(f"[ERROR] run_batch unexpected: {repr(e)}")
+    finally:
+        _aggregate_batch(batch, children)
+        notify_job(batch)
+
+def _aggregate_batch(batch: Job, children):
+    snaps = [(c.status, c.id, c.progress) for c in children]
+    total = sum(p.total_bytes for _, _, p in snaps)
+    downloaded = sum(p.downloaded_bytes for _, _, p in snaps)
+    speed = sum(p.speed_bytes for st, _, p in snaps if st == "downloading")
+    percent = batch.percent
+    if batch.items:
+        done = {cid: (100 if st in TERMINAL_STATUSES else p.percent) for st, cid, p in snaps}
+        percent = max(percent, int(sum(done.get(it["job_id"], 0) for it in batch.items) / len(batch.items)))
+    eta = int((total - downloaded) / speed) if total > downloaded and speed > 0 else None
+    batch.progress = Progress(percent, downloaded, total, speed, eta)
+
+@app.post("/batch")
+def batch_start():
+    """Start a batch job from {"urls": [...]} or a playlist {"url": ...}; fetch returns a ZIP."""
+    d = request.json or {}
+    if not isinstance(d, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    urls = d.get("urls") or []
+    url = d.get("url", "")
+    if not isinstance(urls, list) or not isinstance(url, str) or (not urls and not URL_RE.match(url)):
+        return jsonify({"error": "Provide a playlist url or a list of urls"}), 400
+    if not isinstance(d.get("format_choice", "video"), str):
+        return jsonify({"error": "format_choice must be a string"}), 400
+    if not registry_has_room():
+        return jsonify({"error": "Too many jobs, try again shortly"}), 503, {"Retry-After": "30"}
+    batch = Job()
+    batch.kind = "batch"
+    JOB_STORE.save(batch)
+    threading.Thread(
+        target=run_batch,
+        args=(batch, client_id(), urls, url, d.get("format_choice", "video"), d.get("video_res"), d.get("audio_bitrate")),
+        daemon=True,
+    ).start()
+    return jsonify({"job_id": batch.id})
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable buffer that zipfile writes into; drained between chunks."""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buf += b
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.pos
+
+    def take(self) -> bytes:
+        data = bytes(self.buf)
+        self.buf.clear()
+        return data
+
+def _zip_stream(files):
+    """Yield a stored (uncompressed) ZIP of files built on the fly, without a copy on disk.
+
+    files are (name, path) pairs; a urllib Request instead of a path is a
+    member held by another node, read through its /fetch.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, path in files:
+            if isinstance(path, urllib.request.Request):
+                info = zipfile.ZipInfo(name, time.localtime()[:6])
+                opened = urllib.request.urlopen(path, timeout=STREAM_START_TIMEOUT + 10)
+            else:
+                info = zipfile.ZipInfo.from_file(path, arcname=name)
+                opened = open(path, "rb")
+            info.compress_type = zipfile.ZIP_STORED
+            with opened as src, zf.open(info, "w", force_zip64=True) as dst:
+                while True:
+                    chunk = src.read(256 * 1024)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+def _send_batch_zip(batch: Job):
+    """ZIP of a batch's finished items; in cluster mode items on other nodes are streamed from there."""
+    files, held, names = [], [], set()
+    routed = {"X-Hyper-Client": client_id(), "X-Hyper-Routed": NODE_ID}
+    for it in batch.items or []:
+        child = JOB_STORE.get(it["job_id"]) if it["job_id"] else None
+        if not child or not child.file:
+            continue
+        if CLUSTER_BACKEND and child.node != NODE_ID:
+            base = JOB_STORE.node_url(child.node)
+            if not base or child.status not in ("finished", "downloaded"):
+                continue
+            src = urllib.request.Request(f"{base.rstrip('/')}/fetch/{child.id}", headers=routed)
+        elif not os.path.exists(child.file):
+            continue
+        else:
+            src = child.file
+            if child.artifact and ARTIFACTS.acquire(child.artifact):
+                held.append(child.artifact)
+        name = child.download_name or os.path.basename(child.file)
+        stem, ext = os.path.splitext(name)
+        n = 2
+        while name in names:
+            name = f"{stem} ({n}){ext}"
+            n += 1
+        names.add(name)
+        files.append((name, src))
+    if not files:
+        return jsonify({"error": "File not ready"}), 400
+    batch.downloaded_at = time.time()
+    batch.status = "downloaded"
+    batch.active_fetches += 1
+    notify_job(batch)
+
+    def done():
+        batch.active_fetches -= 1
+        batch.downloaded_at = time.time()
+        EXPIRY.schedule(batch)
+        for digest in held:
+            ARTIFACTS.release(digest)
+
+    prefix_safe = _FILENAME_SANITIZE_RE.sub("_", APP_PREFIX.strip() or "Hyper_Downloader")
+    resp = Response(ClosingIterator(_metered(_zip_stream(files), "zip", EGRESS.bucket(client_id())), done), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = _content_disposition(f"{prefix_safe}__batch.zip")
+    resp.headers["X-Delivery-Mode"] = "zip"
+    return resp
+
+def _drop_job(job: Job, reason: str):
+    """Terminate a job that never ran: fail its followers and free its temp dir."""
+    job.status = "error"
+    job.error = reason
+    if job.artifact and not job.leader:
+        _settle_followers(job)
+    notify_job(job)
+    shutil.rmtree(str(job.tmp), ignore_errors=True)
+
+class JobCancelled(Exception):
+    """Raised from yt-dlp hooks to abort a cancelled job."""
+
+def _kill_job_processes(job: Job):
+    """Kill ffmpeg (or other helper) processes we spawned for job.
+
+    yt-dlp gives no handle on its subprocesses, so they are found through
+    /proc by parent pid and a command line referencing the job's temp dir.
+    No-op where /proc is unavailable.
+    """
+    marker = str(job.tmp).encode()
+    me = os.getpid()
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "rb") as f:
+                ppid = int(f.read().rsplit(b")", 1)[1].split()[1])
+            if ppid != me:
+                continue
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if marker not in f.read():
+                    continue
+            os.kill(int(pid), signal.SIGKILL)
+            if DEBUG_LOG:
+                print(f"[DEBUG] killed pid {pid} of cancelled job {job.id}")
+        except (OSError, ValueError, IndexError):
+            continue
+
+def cancel_job_now(job: Job):
+    """Cancel a job owned by this process, wherever it is in its lifecycle.
+
+    A job producing an artifact that other jobs are attached to is only
+    detached from its client: the download goes on for them and is stopped
+    once the last of them leaves.
+    """
+    if (job.artifact and not job.leader and job.status not in TERMINAL_STATUSES
+            and ARTIFACTS.followers(job.artifact, job.id)):
+        job.cancel_requested = False  # a request from another worker, applied here
+        if not job.detached:
+            job.detached = True
+            job.error = "Cancelled"
+            notify_job(job)
+        return
+    job.cancel_requested = True
+    if SCHEDULER.cancel(job.id):
+        _drop_job(job, "Cancelled")
+        return
+    if job.status in TERMINAL_STATUSES:
+        return
+    if job.leader:
+        # only waiting on another job: just detach
+        _drop_job(job, "Cancelled")
+        leader = JOBS.get(job.leader)
+        if not ARTIFACTS.leave(job.artifact, job.leader, job.id) and leader and leader.detached:
+            cancel_job_now(leader)
+        return
+    # running: free the slot now, stop helpers; run_download unwinds via the hooks
+    SCHEDULER.release(job.id)
+    _kill_job_processes(job)
+    job.status = "error"
+    job.error = "Cancelled"
+    notify_job(job)
+
+def request_cancel(job: Job) -> bool:
+    """Cancel a job owned by another process or node; True if it was still in the shared queue
+    (cancelled now), otherwise the owner picks the request up from the store."""
+    job.cancel_requested = True
+    if CLUSTER_BACKEND and JOB_STORE.backend.unqueue(job.id):
+        job.status = "error"
+        job.error = "Cancelled"
+        JOB_STORE.settle(job)
+        notify_job(job)
+        return True
+    JOB_STORE.save(job)
+    return False
+
+@app.delete("/jobs/<id>")
+def cancel_job(id):
+    """Cancel a queued or running job."""
+    j = JOB_STORE.get(id)
+    if not j:
+        abort(404)
+    if j.status in TERMINAL_STATUSES:
+        return jsonify({"job_id": id, "cancelled": False, "error": "Job already " + j.status}), 409
+    if not j.local:
+        if request_cancel(j):
+            return jsonify({"job_id": id, "cancelled": True})
+        return jsonify({"job_id": id, "cancelled": True, "pending": True}), 202
+    cancel_job_now(j)
+    return jsonify({"job_id": id, "cancelled": True})
+
+def abandon_worker():
+    """Cancel jobs whose client stopped polling, and apply cancels requested via other workers."""
+    interval = max(1.0, min(5.0, ABANDON_SECONDS / 4)) if ABANDON_SECONDS else 5.0
+    while True:
+        time.sleep(interval)
+        try:
+            now = time.time()
+            for job in list(JOBS.values()):
+                if job.status in TERMINAL_STATUSES:
+                    continue
+                JOB_STORE.sync(job)
+                if job.cancel_requested or (ABANDON_SECONDS and now - job.last_seen > ABANDON_SECONDS):
+                    if DEBUG_LOG:
+                        print(f"[DEBUG] cancelling job {job.id} (requested={job.cancel_requested})")
+                    cancel_job_now(job)
+        except Exception as e:
+            if DEBUG_LOG:
+                print("[abandon] error:", repr(e))
+
+threading.Thread(target=abandon_worker, daemon=True).start()
 
 @app.post("/info")
 def info():
     d = request.json or {}
     url = d.get("url", "")
     try:
-        with YoutubeDL({"skip_download": True, "quiet": True, "noplaylist": True}) as y:
-            info = y.extract_info(url, download=False)
+        info = INFO_CACHE.get_or_extract(url)
         title = info.get("title", "")
         channel = info.get("uploader") or info.get("channel", "")
         thumb = info.get("thumbnail")
         dur = info.get("duration") or 0
-        return jsonify({"title": title, "thumbnail": thumb, "channel": channel, "duration_str": f"{dur//60}:{dur%60:02d}"})
+        # what a download with these settings would fetch (format ids, merge or not, size)
+        plan = plan_formats(info.get("formats"), d.get("format_choice", "video"), d.get("video_res"), dur, HAS_FFMPEG)
+        return jsonify({"title": title, "thumbnail": thumb, "channel": channel, "duration_str": f"{dur//60}:{dur%60:02d}",
+                        "plan": plan})
     except Exception as e:
+        METRICS.inc("hyper_errors_total", category="preview")
         if DEBUG_LOG:
             print("[DEBUG] preview failed:", repr(e))
         return jsonify({"error": "Preview failed", "detail": str(e)[:400]}), 400
 
+def _touch(j: Job):
+    """A client is watching j (and, through it, the job it is attached to)."""
+    JOB_STORE.touch(j)
+    if j.leader:
+        leader = JOB_STORE.get(j.leader)
+        if leader:
+            JOB_STORE.touch(leader)
+
+def _progress_payload(j: Job) -> dict:
+    src = j
+    if j.leader and j.status == "queued":
+        # attached to another job producing the same file: report its progress
+        src = JOB_STORE.get(j.leader) or j
+    p = src.progress  # one snapshot: the fields below always belong together
+    status = src.status if src is not j and src.status in ("queued", "downloading") else j.status
+    payload = {
+        "percent": p.percent,
+        "status": "error" if j.detached else status,
+        "error": j.error,
+        "speed_bytes": p.speed_bytes,
+        "downloaded_bytes": p.downloaded_bytes,
+        "total_bytes": p.total_bytes,
+        "eta_seconds": p.eta_seconds,
+        "delivery_mode": src.delivery_mode,
+        "version": j.version
+    }
+    if INGRESS.total:
+        payload["rate_limit"] = INGRESS.allocation(src.id)
+    if CLUSTER_BACKEND:
+        payload["node"] = src.node
+    if j.kind == "batch":
+        payload["items"] = []
+        for it in j.items or []:
+            child = JOB_STORE.get(it["job_id"]) if it["job_id"] else None
+            payload["items"].append({
+                "job_id": it["job_id"],
+                "title": it["title"],
+                "url": it["url"],
+                "status": child.status if child else "queued",
+                "percent": child.percent if child else 0,
+                "error": child.error if child else None,
+            })
+    if j.status == "queued" and j.local:
+        where = SCHEDULER.position(j.id)
+        if where:
+            payload["queue_lane"], payload["queue_position"] = where
+    return payload
+
 @app.get("/progress/<id>")
 def progress(id):
-    j = JOBS.get(id)
+    j = JOB_STORE.get(id)
     if not j:
         abort(404)
-    speed_b = getattr(j, "speed_bytes", 0) or 0
-    eta_seconds = None
-    downloaded = getattr(j, "downloaded_bytes", 0) or 0
-    total = getattr(j, "total_bytes", 0) or 0
-    if total > 0 and downloaded > 0 and speed_b and speed_b > 0 and downloaded < total:
-        try:
-            eta_seconds = int((total - downloaded) / speed_b)
-        except Exception:
-            eta_seconds = None
-    return jsonify({
-        "percent": j.percent,
-        "status": j.status,
-        "error": j.error,
-        "speed_bytes": speed_b,
-        "downloaded_bytes": downloaded,
-        "total_bytes": total,
-        "eta_seconds": eta_seconds
-    })
+    _touch(j)
+    since = request.args.get("since", type=int)
+    if since is not None and j.status not in TERMINAL_STATUSES:
+        # long-poll: hold the request until something newer than `since` is published
+        j, _ = JOB_STORE.wait(j, since, PROGRESS_WAIT_SECONDS)
+    return jsonify(_progress_payload(j))
+
+@app.get("/progress/<id>/stream")
+def progress_stream(id):
+    """Server-Sent Events stream of progress snapshots, one event per published change."""
+    j = JOB_STORE.get(id)
+    if not j:
+        abort(404)
+    try:
+        since = int(request.headers.get("Last-Event-ID", -1))
+    except ValueError:
+        since = -1
+
+    def events(j, since):
+        while True:
+            # an open stream counts as watching
+            _touch(j)
+            j, version = JOB_STORE.wait(j, since, min(PROGRESS_WAIT_SECONDS, ABANDON_SECONDS / 2 or PROGRESS_WAIT_SECONDS))
+            if version <= since:
+                yield ": keepalive\n\n"
+                continue
+            payload = _progress_payload(j)
+            since = payload["version"]
+            yield f"id: {since}\ndata: {json.dumps(payload)}\n\n"
+            if payload["status"] in TERMINAL_STATUSES:
+                return
+
+    return Response(events(j, since), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _metered(chunks, mode: str, bucket: TokenBucket = None):
+    """Pass chunks through, recording bytes and duration of the transfer in METRICS.
+
+    With a bucket, each chunk is held back until the client's egress cap allows it.
+    """
+    started, sent = time.time(), 0
+    try:
+        for chunk in chunks:
+            if bucket and chunk:
+                wait = bucket.take(len(chunk))
+                if wait:
+                    time.sleep(wait)
+            sent += len(chunk)
+            yield chunk
+    finally:
+        METRICS.inc("hyper_fetch_bytes_total", sent, mode=mode)
+        METRICS.observe("hyper_phase_seconds", time.time() - started, phase="fetch")
+
+class _Idle(bytes):
+    """Empty chunk marking "nothing new yet"; only yielded to the ASGI bridge, which sleeps on its loop."""
+
+ASGI_IDLE = _Idle()
+
+def _tail_file(job_id: str, path: str, idle=None):
+    """Yield a file's bytes as it grows until the job producing it is done.
+
+    With idle set, it is yielded instead of sleeping while waiting for more data.
+    """
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(256 * 1024)
+            if chunk:
+                yield chunk
+                continue
+            j = JOB_STORE.get(job_id)
+            if not j or j.status == "error":
+                # the producer failed; the client sees a truncated transfer
+                return
+            if j.status in TERMINAL_STATUSES:
+                # finished: the file (now possibly moved into the result cache) is complete
+                rest = f.read()
+                if rest:
+                    yield rest
+                return
+            if idle is not None:
+                yield idle
+            else:
+                time.sleep(0.2)
+
+def _stream_pending(src: Job) -> bool:
+    """src may still start writing a streamable file that /fetch could tail."""
+    return (src.status not in TERMINAL_STATUSES and src.delivery_mode != "file" and src.node == NODE_ID
+            and not (src.stream_path and os.path.exists(src.stream_path)))
 
 @app.get("/fetch/<id>")
 def fetch(id):
-    j = JOBS.get(id)
+    j = JOB_STORE.get(id)
     if not j:
         abort(404)
+    if CLUSTER_BACKEND and j.node != NODE_ID and j.kind != "batch":
+        return _route_to_node(j)
+    if j.kind == "batch":
+        if j.status not in ("finished", "downloaded"):
+            return jsonify({"error": "File not ready"}), 400
+        return _send_batch_zip(j)
+    if not j.file and j.status not in TERMINAL_STATUSES and j.delivery_mode != "file":
+        # streaming job: wait until there is something to tail (or the job finishes);
+        # an attached job tails the file of the job producing it
+        src = (JOB_STORE.get(j.leader) or j) if j.leader else j
+        # the ASGI bridge has already waited on its event loop and passes its deadline along
+        deadline = request.environ.get("hyper.stream_deadline") or time.time() + STREAM_START_TIMEOUT
+        while _stream_pending(src) and time.time() < deadline:
+            src, _ = JOB_STORE.wait(src, src.version, min(1.0, deadline - time.time()))
+        if src.status not in TERMINAL_STATUSES and src.stream_path and os.path.exists(src.stream_path):
+            return _stream_fetch(j, src)
+        j = JOB_STORE.get(id) or j
     if not j.file or not os.path.exists(j.file):
-        return jsonify({"error": "File not ready"}), 400
+        return jsonify({"error": "File not ready", "delivery_mode": j.delivery_mode}), 400
+    return _send_job_file(j)
+
+ROUTED_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+PROXIED_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Content-Disposition", "Accept-Ranges",
+                   "ETag", "Last-Modified", "Cache-Control", "X-Delivery-Mode")
+
+def _route_to_node(j: Job):
+    """Answer a /fetch for a job whose files are on another node: redirect there, or proxy it.
+
+    Proxied requests carry the client's address (for per-client limits) and
+    X-Hyper-Routed, so a node never forwards a request a second time.
+    """
+    base = JOB_STORE.node_url(j.node)
+    if not base or request.headers.get("X-Hyper-Routed"):
+        return jsonify({"error": "The node holding this file is unavailable"}), 503
+    target = base.rstrip("/") + request.full_path.rstrip("?")
+    if FETCH_ROUTING == "redirect":
+        return Response(status=307, headers={"Location": target})
+    headers = {k: request.headers[k] for k in ROUTED_HEADERS if k in request.headers}
+    headers.update({"X-Hyper-Client": client_id(), "X-Hyper-Routed": NODE_ID})
+    try:
+        upstream = urllib.request.urlopen(urllib.request.Request(target, headers=headers, method=request.method),
+                                          timeout=STREAM_START_TIMEOUT + 10)
+    except urllib.error.HTTPError as e:
+        upstream = e  # 304 / 400 / 416 ...: passed through as they are
+    except (urllib.error.URLError, OSError):
+        return jsonify({"error": "The node holding this file is unavailable"}), 503
+
+    def body():
+        with upstream:
+            while True:
+                chunk = upstream.read(256 * 1024)
+                if not chunk:
+                    return
+                yield chunk
+
+    out = {k: upstream.headers[k] for k in PROXIED_HEADERS if upstream.headers.get(k)}
+    return Response(body(), status=upstream.status, headers=out, direct_passthrough=True)
+
+class _FetchFile(io.FileIO):
+    """File handed to the WSGI server; runs a callback when the server closes it."""
+
+    def __init__(self, path, on_close):
+        super().__init__(path, "rb")
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            cb, self._on_close = self._on_close, None
+            if cb:
+                cb()
+
+class _RangeBody:
+    """Iterate length bytes of f, paced by bucket if given; closing it (even unstarted) closes f."""
+
+    def __init__(self, f, length: int, chunk: int = 256 * 1024, bucket: TokenBucket = None):
+        self.f = f
+        self.length = length
+        self.chunk = chunk
+        self.bucket = bucket
+
+    def __iter__(self):
+        while self.length > 0:
+            data = self.f.read(min(self.chunk, self.length))
+            if not data:
+                break
+            self.length -= len(data)
+            if self.bucket:
+                wait = self.bucket.take(len(data))
+                if wait:
+                    time.sleep(wait)
+            yield data
+
+    def close(self):
+        self.f.close()
+
+def _content_disposition(name: str) -> str:
+    ascii_name = name.encode("ascii", "replace").decode("ascii").replace('"', "_")
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name)}"
+
+def _send_job_file(j: Job):
+    """Send a finished file with ETag / Range / If-Range support.
+
+    Under gunicorn the opened file goes out through wsgi.file_wrapper, which
+    gunicorn sends with sendfile(2) (ranges included, via the file offset and
+    Content-Length), unless the client has an egress cap to be paced to. Ranged fetches switch the job to RESUME_KEEP_SECONDS
+    retention, counted from the end of the last transfer.
+    """
+    path = j.file
+    st = os.stat(path)
+    size = st.st_size
+    etag = f"{size:x}-{st.st_mtime_ns:x}"
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-transform",
+        "Content-Disposition": _content_disposition(j.download_name or os.path.basename(path)),
+        "X-Delivery-Mode": "file",
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+    rng = request.range
+    if rng is not None and "If-Range" in request.headers:
+        # resume only if the client still has the same file
+        if request.if_range.etag != etag and request.if_range.date is None:
+            rng = None
+        elif request.if_range.date is not None and int(st.st_mtime) > request.if_range.date.timestamp():
+            rng = None
+    if rng is not None:
+        span = rng.range_for_length(size)
+        if span is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, stop = span
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        if not j.ranged:
+            j.ranged = True
+    length = stop - start
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if request.method == "HEAD":
+        resp = Response(status=status, headers=headers, mimetype=mimetype)
+        resp.content_length = length
+        return resp
+
     j.downloaded_at = time.time()
     j.status = "downloaded"
-    # send_file will stream
-    return send_file(j.file, as_attachment=True, download_name=os.path.basename(j.file))
+    j.active_fetches += 1
+    notify_job(j)
+    # hold a reference on the shared artifact so eviction can't remove it mid-transfer
+    held = j.artifact if j.artifact and ARTIFACTS.acquire(j.artifact) else None
+    started = time.time()
+
+    def done():
+        # sendfile bypasses Python, so the byte count is what the response promised
+        METRICS.inc("hyper_fetch_bytes_total", length, mode="file")
+        METRICS.observe("hyper_phase_seconds", time.time() - started, phase="fetch")
+        j.active_fetches -= 1
+        j.downloaded_at = time.time()
+        JOB_STORE.save(j)
+        EXPIRY.schedule(j)
+        if held:
+            ARTIFACTS.release(held)
+
+    f = _FetchFile(path, done)
+    f.seek(start)
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    bucket = EGRESS.bucket(client_id())
+    if wrapper and not bucket and request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+        # gunicorn stops at Content-Length and uses sendfile(2) when it can
+        body = wrapper(f, 256 * 1024)
+    else:
+        # a capped client is paced chunk by chunk, which sendfile can't do
+        body = _RangeBody(f, length, bucket=bucket)
+    resp = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    resp.content_length = length
+    resp.last_modified = st.st_mtime
+    return resp
+
+def _stream_fetch(j: Job, src: Job):
+    """Send src's still-growing download chunked; j counts as fetched once the stream completes."""
+    job_id = j.id
+
+    def done():
+        job = JOB_STORE.get(job_id)
+        if job and job.status == "finished":
+            job.downloaded_at = time.time()
+            job.status = "downloaded"
+            notify_job(job)
+
+    name = os.path.basename(src.stream_path)
+    mimetype = "video/mp4" if name.endswith(".mp4") else "application/octet-stream"
+    idle = ASGI_IDLE if request.environ.get("hyper.asgi") else None
+    body = _metered(_tail_file(src.id, src.stream_path, idle), src.delivery_mode, EGRESS.bucket(client_id()))
+    resp = Response(ClosingIterator(body, done), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = _content_disposition(name)
+    resp.headers["X-Delivery-Mode"] = src.delivery_mode
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 @app.get("/env")
 def env():
@@ -734,41 +4057,548 @@ def env():
         "ffmpeg_path": _FFMPEG,
         "debug": DEBUG_LOG,
         "prefix": APP_PREFIX,
-        "max_concurrent": MAX_CONCURRENT
+        "max_concurrent": MAX_CONCURRENT,
+        "scheduler": SCHEDULER.stats(),
+        "storage": STORAGE.stats(),
+        "transcode": TRANSCODES.stats(),
+        "memory": memory_report(),
+        "startup": STARTUP,
+        "info_pool": EXTRACTOR_POOL.stats(),
+        "connections": dict(CONNECTIONS.stats(), per_job=JOB_CONNECTIONS, external_downloader=_EXTERNAL_DL),
+        "bandwidth": {"ingress": INGRESS.stats(), "egress": EGRESS.stats()},
+        "cluster": cluster_report(),
+        "info_cache": {
+            "size": len(INFO_CACHE.entries),
+            "max_size": INFO_CACHE_SIZE,
+            "ttl": INFO_CACHE_TTL,
+            "hits": INFO_CACHE.hits,
+            "misses": INFO_CACHE.misses,
+            "coalesced": INFO_CACHE.coalesced,
+        },
+        "result_cache": {
+            "artifacts": ARTIFACTS.count,
+            "bytes": ARTIFACTS.total_bytes,
+            "max_bytes": ARTIFACT_CACHE_BYTES,
+            "hits": ARTIFACTS.hits,
+            "misses": ARTIFACTS.misses,
+        },
+        "metrics": "/metrics",
     })
 
+def cluster_report():
+    if not CLUSTER_BACKEND:
+        return None
+    now = time.time()
+    return {
+        "node": NODE_ID,
+        "role": NODE_ROLE,
+        "url": NODE_URL,
+        "backend": CLUSTER_BACKEND.split("://", 1)[0] if "://" in CLUSTER_BACKEND else "sqlite",
+        "fetch_routing": FETCH_ROUTING,
+        "queue": JOB_STORE.backend.depth(),
+        "nodes": {n: {"url": u, "seen_seconds_ago": round(now - seen, 1), "alive": JOB_STORE.node_alive(n)}
+                  for n, (u, seen) in JOB_STORE.peers.items()},
+    }
+
+def _scheduler_gauges():
+    st = SCHEDULER.stats()
+    return {(("lane", lane),): n for lane, n in st["lanes"].items()}
+
+METRICS.gauge("hyper_queue_depth", "Jobs waiting in the scheduler, per lane.", _scheduler_gauges)
+METRICS.gauge("hyper_active_downloads", "Downloads currently running.",
+              lambda: {(): SCHEDULER.stats()["active"]})
+METRICS.gauge("hyper_connections_in_use", "Upstream connections granted to running downloads.",
+              lambda: {(): CONNECTIONS.stats()["used"]})
+METRICS.gauge("hyper_cache_hits", "Cache hits since start.",
+              lambda: {(("cache", "info"),): INFO_CACHE.hits, (("cache", "result"),): ARTIFACTS.hits})
+METRICS.gauge("hyper_cache_misses", "Cache misses since start.",
+              lambda: {(("cache", "info"),): INFO_CACHE.misses, (("cache", "result"),): ARTIFACTS.misses})
+METRICS.gauge("hyper_cache_coalesced", "Metadata lookups that joined an extraction already in flight.",
+              lambda: {(("cache", "info"),): INFO_CACHE.coalesced})
+METRICS.gauge("hyper_result_cache_bytes", "Bytes held by the result cache.",
+              lambda: {(): ARTIFACTS.total_bytes})
+
+@app.get("/metrics")
+def metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+def expiry_deadline(job: Job):
+    """When job and its files may be removed, or None while it is still in use."""
+    # finished/error: JOB_TTL_SECONDS after creation
+    if job.status in ("finished", "error"):
+        return job.created_at + JOB_TTL_SECONDS
+    # downloaded: DOWNLOAD_KEEP_SECONDS after the last transfer ended (RESUME_KEEP_SECONDS once
+    # a client used ranges); never while a fetch is still sending
+    if job.status == "downloaded" and job.downloaded_at and not job.active_fetches:
+        return job.downloaded_at + (RESUME_KEEP_SECONDS if job.ranged else DOWNLOAD_KEEP_SECONDS)
+    return None
+
+def remove_jobs(ids) -> int:
+    """Forget jobs (batch items go with their batch) and delete their temp dirs in the cleanup pool."""
+    remove = list(ids)
+    for rid in list(remove):
+        # batch items go together with their batch
+        j = JOB_STORE.get(rid)
+        if j and j.kind == "batch":
+            remove += [it["job_id"] for it in j.items or [] if it["job_id"]]
+    for rid in remove:
+        j = JOB_STORE.get(rid)
+        JOB_STORE.remove(rid)
+        EXPIRY.discard(rid)
+        if j and j.node in (NODE_ID, None):
+            EXPIRY.pool.submit(shutil.rmtree, str(j.tmp), ignore_errors=True)
+            if j.local and j.artifact and j.file:
+                ARTIFACTS.release(j.artifact)
+    return len(remove)
+
+def registry_has_room() -> bool:
+    """Keep JOBS under MAX_JOBS: drop the oldest finished jobs to make room; False if all are live."""
+    if len(JOBS) < MAX_JOBS:
+        return True
+    # free a few percent at once so the scan isn't repeated for every new job
+    excess = len(JOBS) - MAX_JOBS + 1 + MAX_JOBS // 20
+    done = [j for j in JOB_STORE.all() if j.local and j.kind == "single" and expiry_deadline(j) is not None]
+    remove_jobs([j.id for j in heapq.nsmallest(excess, done, key=lambda j: j.created_at)])
+    if DEBUG_LOG:
+        print(f"[cleanup] job registry full, dropped {min(excess, len(done))} finished jobs")
+    return len(JOBS) < MAX_JOBS
+
+def memory_report() -> dict:
+    """Approximate memory held by the job registry (shallow sizes, sampled) and the process RSS."""
+    jobs = JOB_STORE.all()
+    sample = jobs[:500]
+    per_job = 0
+    if sample:
+        per_job = sum(sys.getsizeof(j) + sum(sys.getsizeof(getattr(j, k)) for k in Job.PERSISTED)
+                      for j in sample) // len(sample)
+    rss = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return {
+        "jobs": len(jobs),
+        "max_jobs": MAX_JOBS,
+        "terminal_jobs": sum(1 for j in jobs if j.status in TERMINAL_STATUSES),
+        "approx_job_bytes": per_job,
+        "approx_registry_bytes": per_job * len(jobs),
+        "pending_expiries": len(EXPIRY),
+        "rss_bytes": rss,
+    }
+
+class ExpiryQueue:
+    """Min-heap of job deadlines served by one thread, so each job goes close to its real expiry.
+
+    Entries are (deadline, job id); a later schedule() for the same job
+    supersedes the earlier entry, which is skipped when popped. The deadline
+    is re-checked against the job at pop time, since a fetch may have
+    started or a resume extended it.
+    """
+
+    def __init__(self, threads: int):
+        self.heap = []
+        self.current = {}  # job id -> deadline of its live heap entry
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="cleanup")
+
+    def schedule(self, job: Job):
+        deadline = expiry_deadline(job)
+        if deadline is None:
+            return
+        with self.cond:
+            if self.current.get(job.id) == deadline:
+                return
+            self.current[job.id] = deadline
+            heapq.heappush(self.heap, (deadline, job.id))
+            if self.heap[0][1] == job.id:
+                self.cond.notify()
+
+    def discard(self, job_id: str):
+        """Forget a removed job; its heap entry is skipped when popped, and dead entries are compacted."""
+        with self.cond:
+            if self.current.pop(job_id, None) is not None and len(self.heap) > 2 * len(self.current) + 64:
+                self.heap = [(d, jid) for d, jid in self.heap if self.current.get(jid) == d]
+                heapq.heapify(self.heap)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                deadline, jid = heapq.heappop(self.heap)
+                if self.current.get(jid) != deadline:
+                    continue  # superseded by a later schedule()
+                del self.current[jid]
+            try:
+                job = JOB_STORE.get(jid)
+                if not job:
+                    continue
+                due = expiry_deadline(job)
+                if due is None:
+                    continue  # in use again; the end of that use reschedules it
+                if due > time.time():
+                    self.schedule(job)
+                    continue
+                remove_jobs([jid])
+            except Exception as e:
+                if DEBUG_LOG:
+                    print("[cleanup] expiry error:", repr(e))
+
+    def __len__(self):
+        with self.cond:
+            return len(self.current)
+
+EXPIRY = ExpiryQueue(CLEANUP_THREADS)
+
+_JOB_DIR_RE = re.compile(r"^mvd_(\d+)_")
+
+def sweep_orphan_dirs() -> int:
+    """Delete job temp dirs left behind by crashed processes (their owner pid is gone).
+
+    Dirs without a pid (older versions) or whose pid was reused are removed
+    once they are older than any job could live; so are dirs carrying our
+    own pid that no registered job uses (left by an earlier process with
+    the same pid, e.g. PID 1 in a container).
+    """
+    max_age = JOB_TTL_SECONDS + RESUME_KEEP_SECONDS
+    now = time.time()
+    removed = 0
+    live = {os.path.basename(j._tmp) for j in list(JOBS.values())}
+    for base in {WORK_DIR, AUDIO_WORK_DIR}:
+        for path in glob.glob(os.path.join(base, "mvd_*")):
+            name = os.path.basename(path)
+            m = _JOB_DIR_RE.match(name)
+            own = bool(m) and int(m.group(1)) == os.getpid()
+            if own and name in live:
+                continue
+            try:
+                old = now - os.path.getmtime(path) > max_age
+            except OSError:
+                continue
+            if (m and not own and not _pid_alive(m.group(1))) or old:
+                EXPIRY.pool.submit(shutil.rmtree, path, ignore_errors=True)
+                removed += 1
+    if DEBUG_LOG and removed:
+        print(f"[cleanup] removing {removed} orphaned job dirs")
+    return removed
+
+def cleanup_once():
+    """Backstop pass: drop every expired job (including ones expired in other processes), then expire cached artifacts."""
+    now = time.time()
+    remove = []
+    for job in JOB_STORE.all():
+        deadline = expiry_deadline(job)
+        if deadline is not None and now > deadline:
+            remove.append(job.id)
+    n = remove_jobs(remove)
+    ARTIFACTS.expire()
+    return n
+
 def cleanup_worker():
     while True:
         try:
-            now = time.time()
-            remove = []
-            for jid, job in list(JOBS.items()):
-                # finished/error older than TTL -> remove
-                if job.status in ("finished", "error") and (now - job.created_at > JOB_TTL_SECONDS):
-                    remove.append(jid)
-                # downloaded and fetched file older than DOWNLOAD_KEEP_SECONDS -> remove
-                if job.status == "downloaded" and job.downloaded_at and (now - job.downloaded_at > DOWNLOAD_KEEP_SECONDS):
-                    remove.append(jid)
-            for rid in remove:
-                j = JOBS.pop(rid, None)
-                if j:
-                    try:
-                        shutil.rmtree(str(j.tmp), ignore_errors=True)
-                    except Exception:
-                        pass
+            cleanup_once()
         except Exception as e:
             if DEBUG_LOG:
                 print("[cleanup] error:", repr(e))
         time.sleep(CLEANUP_INTERVAL)
 
+threading.Thread(target=EXPIRY.run, daemon=True).start()
+threading.Thread(target=sweep_orphan_dirs, daemon=True).start()
 threading.Thread(target=cleanup_worker, daemon=True).start()
 
+def prewarm():
+    """Load yt-dlp and fill the extractor pool in the background after boot."""
+    t0 = time.perf_counter()
+    try:
+        video_key("")
+        EXTRACTOR_POOL.warm()
+    except Exception as e:
+        if DEBUG_LOG:
+            print("[startup] prewarm failed:", repr(e))
+        return
+    STARTUP["prewarm"] = round(time.perf_counter() - t0, 3)
+    STARTUP["warm"] = round(time.perf_counter() - _BOOT, 3)
+    if DEBUG_LOG:
+        print("[startup]", STARTUP)
+
+if PREWARM:
+    threading.Thread(target=prewarm, daemon=True).start()
+if CLUSTER_BACKEND and NODE_ROLE != "web":
+    threading.Thread(target=cluster_puller, daemon=True).start()
+
+# ---------- ASGI serving mode ----------
+class AsgiApp:
+    """ASGI entry point exposing the same routes and jobs as the Flask app.
+
+    Progress long-polls and SSE streams wait on the event loop, and the
+    streaming-start wait of /fetch happens there too. Every other request
+    (including /fetch itself) runs the Flask view in a thread pool, but
+    response bodies are pulled one chunk at a time and sent from the loop,
+    so a slow client holds no thread while its socket drains. Downloads
+    still run in the scheduler's worker threads.
+
+        uvicorn app:asgi_app --port 5000        (or SERVER_MODE=asgi python app.py)
+    """
+
+    PROGRESS_RE = re.compile(r"^/progress/([^/]+)(/stream)?$")
+    FETCH_RE = re.compile(r"^/fetch/([^/]+)$")
+
+    def __init__(self, wsgi_app, threads: int):
+        self.wsgi_app = wsgi_app
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                msg = await receive()
+                if msg["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif msg["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        path = scope["path"]
+        root = scope.get("root_path", "")
+        if root and path.startswith(root):
+            path = path[len(root):]
+        environ = {}
+        if scope["method"] == "GET":
+            m = self.PROGRESS_RE.match(path)
+            if m:
+                job = JOB_STORE.get(m.group(1))
+                if not job:
+                    return await self._wsgi(scope, receive, send, environ)
+                if m.group(2):
+                    return await self._progress_stream(scope, receive, send, job)
+                return await self._progress(scope, send, job)
+        if scope["method"] in ("GET", "HEAD"):
+            m = self.FETCH_RE.match(path)
+            if m:
+                environ["hyper.stream_deadline"] = await self._await_stream_start(m.group(1))
+        return await self._wsgi(scope, receive, send, environ)
+
+    @staticmethod
+    def _header(scope, name: bytes):
+        for k, v in scope["headers"]:
+            if k == name:
+                return v.decode("latin-1")
+        return None
+
+    async def _progress(self, scope, send, j):
+        _touch(j)
+        query = dict(p.split("=", 1) for p in scope.get("query_string", b"").decode("latin-1").split("&") if "=" in p)
+        try:
+            since = int(query["since"])
+        except (KeyError, ValueError):
+            since = None
+        if since is not None and j.status not in TERMINAL_STATUSES:
+            j, _ = await async_wait_job(j, since, PROGRESS_WAIT_SECONDS)
+        body = json.dumps(_progress_payload(j)).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _progress_stream(self, scope, receive, send, j):
+        try:
+            since = int(self._header(scope, b"last-event-id") or -1)
+        except ValueError:
+            since = -1
+        # stop touching the job once the tab is gone, so ABANDON_SECONDS can cancel it
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.get_running_loop().create_task(watch())
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                    (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+            while not disconnected.is_set():
+                _touch(j)
+                j, version = await async_wait_job(
+                    j, since, min(PROGRESS_WAIT_SECONDS, ABANDON_SECONDS / 2 or PROGRESS_WAIT_SECONDS))
+                if disconnected.is_set():
+                    return
+                if version <= since:
+                    await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                    continue
+                payload = _progress_payload(j)
+                since = payload["version"]
+                event = f"id: {since}\ndata: {json.dumps(payload)}\n\n".encode()
+                done = payload["status"] in TERMINAL_STATUSES
+                await send({"type": "http.response.body", "body": event, "more_body": not done})
+                if done:
+                    return
+        finally:
+            watcher.cancel()
+
+    async def _await_stream_start(self, job_id: str) -> float:
+        """Wait on the loop until a streaming job has something to tail; returns the wait deadline."""
+        deadline = time.time() + STREAM_START_TIMEOUT
+        j = JOB_STORE.get(job_id)
+        if not j or j.kind == "batch" or j.file or j.status in TERMINAL_STATUSES or j.delivery_mode == "file":
+            return deadline
+        src = (JOB_STORE.get(j.leader) or j) if j.leader else j
+        while _stream_pending(src) and time.time() < deadline:
+            src, _ = await async_wait_job(src, src.version, min(1.0, deadline - time.time()))
+        return deadline
+
+    def _environ(self, scope, body: bytes) -> dict:
+        server = scope.get("server") or ("localhost", 80)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"][len(scope.get("root_path", "")):].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "SERVER_SOFTWARE": "hyper-asgi",
+            "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "CONTENT_LENGTH": str(len(body)),  # the body is buffered, so its length is always known
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "hyper.asgi": True,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ[name] = value
+                continue
+            if name in ("CONTENT_LENGTH", "TRANSFER_ENCODING"):
+                continue
+            key = "HTTP_" + name
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _wsgi(self, scope, receive, send, extra: dict):
+        body = bytearray()
+        while True:
+            msg = await receive()
+            if msg["type"] == "http.disconnect":
+                return
+            body += msg.get("body", b"")
+            if not msg.get("more_body"):
+                break
+        environ = self._environ(scope, bytes(body))
+        environ.update(extra)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+            return lambda data: None
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self.pool, self.wsgi_app, environ, start_response)
+        disconnected = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = loop.create_task(watch())
+        try:
+            chunks = iter(result)
+            await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+            while not disconnected.is_set():
+                chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk is ASGI_IDLE:
+                    await asyncio.sleep(0.2)
+                elif chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            watcher.cancel()
+            close = getattr(result, "close", None)
+            if close:
+                await loop.run_in_executor(self.pool, close)
+
+asgi_app = AsgiApp(app, ASGI_THREADS)
+
+
+# ---------- Static frontend ----------
+class StaticAsset:
+    """A fixed response body prepared once: gzip/br variants, strong ETags, Cache-Control.
+
+    Each encoding is its own representation, so it gets its own ETag
+    (the body hash plus an encoding suffix); any of them revalidates.
+    """
+
+    def __init__(self, body, mimetype: str, cache_control: str):
+        body = body.encode("utf-8") if isinstance(body, str) else body
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        tag = hashlib.sha256(body).hexdigest()[:20]
+        self.variants = {"identity": (body, tag)}
+        gz = gzip.compress(body, 9, mtime=0)
+        if len(gz) < len(body):
+            self.variants["gzip"] = (gz, tag + "-gz")
+        if brotli is not None:
+            br = brotli.compress(body)
+            if len(br) < len(body):
+                self.variants["br"] = (br, tag + "-br")
+
+    def response(self) -> Response:
+        encoding = "identity"
+        for enc in ("br", "gzip"):
+            if enc in self.variants and request.accept_encodings.quality(enc) > 0:
+                encoding = enc
+                break
+        body, tag = self.variants[encoding]
+        headers = {"ETag": f'"{tag}"', "Cache-Control": self.cache_control, "Vary": "Accept-Encoding"}
+        if any(request.if_none_match.contains(t) for _, t in self.variants.values()):
+            return Response(status=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(body, headers=headers, mimetype=self.mimetype)
+
+PAGE_CACHE = "public, max-age=300"
+ASSET_CACHE = "public, max-age=31536000, immutable"  # fingerprinted: the name changes with the content
+ASSETS = {}  # fingerprinted file name -> StaticAsset, served from /assets/
+
+def _split_inline(page: str, tag: str, ext: str, mimetype: str, ref: str) -> str:
+    """Move the first inline <tag> block of page into a fingerprinted asset and reference it instead."""
+    m = re.search(rf"<{tag}>(.*?)</{tag}>", page, re.S)
+    if not m:
+        return page
+    body = m.group(1).encode("utf-8")
+    name = f"app.{hashlib.sha256(body).hexdigest()[:12]}.{ext}"
+    ASSETS[name] = StaticAsset(body, mimetype, ASSET_CACHE)
+    return page[:m.start()] + ref.format(name) + page[m.end():]
+
+def build_frontend() -> StaticAsset:
+    """Render the landing page once and prepare it (and its split-out CSS/JS) for serving."""
+    with app.app_context():
+        page = render_template_string(HTML)
+    if STATIC_SPLIT:
+        page = _split_inline(page, "style", "css", "text/css", '<link rel="stylesheet" href="/assets/{}">')
+        page = _split_inline(page, "script", "js", "text/javascript", '<script src="/assets/{}"></script>')
+    return StaticAsset(page, "text/html", PAGE_CACHE)
+
+HOME_PAGE = build_frontend()
 
 # ----- SEO ROUTES (SITEMAP + ROBOTS) -----
 
-@app.get("/sitemap.xml")
-def sitemap():
-    xml = """<?xml version="1.0" encoding="UTF-8"?>
+SITEMAP = StaticAsset("""<?xml version="1.0" encoding="UTF-8"?>
 <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
   <url>
     <loc>https://yt-downloader-s52z.onrender.com/</loc>
@@ -776,28 +4606,52 @@ def sitemap():
     <changefreq>daily</changefreq>
   </url>
 </urlset>
-"""
-    return xml, 200, {"Content-Type": "application/xml"}
+""", "application/xml", "public, max-age=3600")
+
+ROBOTS = StaticAsset("""User-agent: *
+Allow: /
+
+Sitemap: https://yt-downloader-s52z.onrender.com/sitemap.xml
+""", "text/plain", "public, max-age=3600")
+
+@app.get("/sitemap.xml")
+def sitemap():
+    return SITEMAP.response()
 
 
 @app.get("/robots.txt")
 def robots():
-    txt = """User-agent: *
-Allow: /
+    return ROBOTS.response()
 
-Sitemap: https://yt-downloader-s52z.onrender.com/sitemap.xml
-"""
-    return txt, 200, {"Content-Type": "text/plain"}
+
+@app.get("/assets/<name>")
+def asset(name):
+    a = ASSETS.get(name)
+    if a is None:
+        abort(404)
+    return a.response()
 
 
 @app.get("/")
 def home():
-    return render_template_string(HTML)
+    return HOME_PAGE.response()
+
+@app.get("/healthz")
+def healthz():
+    # answers as soon as the app is loaded; "warm" tells whether yt-dlp is ready too
+    return jsonify({"ok": True, "warm": "warm" in STARTUP})
+
+STARTUP["app_ready"] = round(time.perf_counter() - _BOOT, 3)
 
 if __name__ == "__main__":
     if DEBUG_LOG:
         print("[INFO] Starting app with config:", {
             "port": PORT, "ffmpeg": HAS_FFMPEG, "ffmpeg_path": _FFMPEG,
-            "debug": DEBUG_LOG, "prefix": APP_PREFIX, "max_concurrent": MAX_CONCURRENT
+            "debug": DEBUG_LOG, "prefix": APP_PREFIX, "max_concurrent": MAX_CONCURRENT,
+            "server_mode": SERVER_MODE,
         })
-    app.run(host="0.0.0.0", port=PORT)
+    if SERVER_MODE == "asgi":
+        import uvicorn  # optional dependency, only needed for the asgi mode
+        uvicorn.run(asgi_app, host="0.0.0.0", port=PORT)
+    else:
+        app.run(host="0.0.0.0", port=PORT)
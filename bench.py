@@ -0,0 +1,343 @@
+"""Offline benchmark / load test for app.py.
+
+Runs the app in-process on a local port with yt-dlp replaced by a stand-in
+that "downloads" synthetic media at a controlled bandwidth, then drives N
+concurrent simulated clients through start -> progress -> fetch. Nothing
+leaves the machine. Results are printed (or written) as JSON:
+
+    python bench.py --clients 20 --jobs 3 --size 2000000 --bandwidth 4000000
+    python bench.py --clients 50 --delivery stream --out bench.json
+
+Per-endpoint request counts, p50/p99 latency and requests/sec, end-to-end
+job time, job registry growth, RSS growth, temp-dir disk usage and the time
+of a cleanup pass are reported.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Offline load test for the downloader (fake extractor, no network).")
+    p.add_argument("--clients", type=int, default=10, help="concurrent simulated clients")
+    p.add_argument("--jobs", type=int, default=3, help="downloads per client")
+    p.add_argument("--size", type=int, default=1_000_000, help="bytes of each synthetic media file")
+    p.add_argument("--bandwidth", type=int, default=5_000_000, help="bytes/s per fake download (0 = unlimited)")
+    p.add_argument("--extract-delay", type=float, default=0.05, help="seconds the fake extractor takes")
+    p.add_argument("--format", default="video", choices=("video", "audio"), help="format_choice sent to /start")
+    p.add_argument("--delivery", default="file", choices=("file", "stream"))
+    p.add_argument("--distinct", type=int, default=0,
+                   help="number of distinct videos requested (0 = every job a new video, no cache hits)")
+    p.add_argument("--poll-interval", type=float, default=0.2, help="seconds between /progress polls")
+    p.add_argument("--max-concurrent", type=int, default=None, help="MAX_CONCURRENT for the server")
+    p.add_argument("--out", help="write the JSON report here instead of stdout")
+    return p.parse_args(argv)
+
+
+class FakeYoutubeDL:
+    """Stand-in for yt_dlp.YoutubeDL: synthetic info dicts and paced file writes."""
+
+    size = 1_000_000
+    bandwidth = 5_000_000
+    extract_delay = 0.05
+    chunk = 64 * 1024
+
+    def __init__(self, opts=None):
+        self.opts = opts or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=True, **kwargs):
+        time.sleep(self.extract_delay)
+        vid = url.rsplit("=", 1)[-1][-11:]
+        info = {
+            "_type": "video", "id": vid, "title": f"Bench {vid}", "duration": 185,
+            "uploader": "bench", "thumbnail": None, "extractor_key": "Youtube",
+            "webpage_url": url, "ext": "mp4", "formats": [],
+        }
+        if download:
+            self.process_ie_result(info, download=True)
+        return info
+
+    def prepare_filename(self, info):
+        tmpl = self.opts.get("outtmpl", "%(title)s.%(ext)s")
+        if isinstance(tmpl, dict):
+            tmpl = tmpl.get("default", "%(title)s.%(ext)s")
+        return tmpl.replace("%(title)s", info["title"]).replace("%(ext)s", info.get("ext", "mp4"))
+
+    def process_ie_result(self, info, download=True):
+        if not download:
+            return info
+        path = self.prepare_filename(info)
+        hooks = self.opts.get("progress_hooks", [])
+        started = time.time()
+        done = 0
+        block = b"\0" * self.chunk
+        with open(path, "wb") as f:
+            while done < self.size:
+                n = min(self.chunk, self.size - done)
+                f.write(block[:n])
+                f.flush()
+                done += n
+                elapsed = max(time.time() - started, 1e-6)
+                for h in hooks:
+                    h({"status": "downloading", "filename": path, "downloaded_bytes": done,
+                       "total_bytes": self.size, "speed": done / elapsed})
+                if self.bandwidth:
+                    ahead = done / self.bandwidth - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        for h in hooks:
+            h({"status": "finished", "filename": path, "total_bytes": self.size})
+        return info
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}  # endpoint -> [seconds]
+        self.status = {}  # endpoint -> {code: count}
+        self.job_seconds = []
+        self.fetched_bytes = 0
+        self.failures = []
+
+    def add(self, endpoint, seconds, code):
+        with self.lock:
+            self.latency.setdefault(endpoint, []).append(seconds)
+            codes = self.status.setdefault(endpoint, {})
+            codes[code] = codes.get(code, 0) + 1
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(q / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def temp_usage(app_module):
+    tmp = tempfile.gettempdir()
+    job_dirs = [os.path.join(tmp, d) for d in os.listdir(tmp) if d.startswith("mvd_")]
+    return {
+        "job_dirs": len(job_dirs),
+        "job_dir_bytes": sum(dir_bytes(d) for d in job_dirs),
+        "artifact_bytes": dir_bytes(app_module.ARTIFACT_DIR),
+    }
+
+
+def rss_kb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def client(port, cid, args, rec, next_id):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    # each simulated client gets its own address so per-client queue limits apply as in production
+    base_headers = {"X-Forwarded-For": f"10.0.{cid // 250}.{cid % 250 + 1}"}
+
+    def call(endpoint, method, path, body=None):
+        headers = dict(base_headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        t0 = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        rec.add(endpoint, time.perf_counter() - t0, resp.status)
+        return resp, data
+
+    for _ in range(args.jobs):
+        n = next_id()
+        vid = n % args.distinct if args.distinct else n
+        url = f"https://www.youtube.com/watch?v=bn{vid:09d}"
+        t_job = time.perf_counter()
+        try:
+            resp, data = call("info", "POST", "/info", {"url": url})
+            resp, data = call("start", "POST", "/start", {
+                "url": url, "format_choice": args.format, "delivery": args.delivery})
+            if resp.status == 429:
+                rec.failures.append("busy")
+                time.sleep(float(resp.getheader("Retry-After") or 1))
+                continue
+            job_id = json.loads(data)["job_id"]
+            while True:
+                resp, data = call("progress", "GET", f"/progress/{job_id}")
+                p = json.loads(data)
+                if p.get("status") in ("finished", "error", "downloaded"):
+                    break
+                if args.delivery == "stream" and p.get("delivery_mode") in ("progressive", "fmp4"):
+                    break
+                time.sleep(args.poll_interval)
+            if p.get("status") == "error":
+                rec.failures.append(p.get("error") or "error")
+                continue
+            resp, data = call("fetch", "GET", f"/fetch/{job_id}")
+            with rec.lock:
+                rec.fetched_bytes += len(data)
+                rec.job_seconds.append(time.perf_counter() - t_job)
+        except Exception as e:
+            rec.failures.append(repr(e)[:200])
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    conn.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # isolate the run: fresh artifact dir, in-memory job store, no background cleanup during the run
+    work = tempfile.mkdtemp(prefix="hyper_bench_")
+    # job dirs (mvd_*) and the artifact cache land in the work dir, so disk usage is this run's alone
+    tempfile.tempdir = work
+    os.environ["ARTIFACT_DIR"] = os.path.join(work, "artifacts")
+    os.environ["JOB_STORE"] = "memory"
+    os.environ["PREWARM"] = "0"  # the pool must be filled with the fake extractor, not real yt-dlp
+    os.environ.setdefault("CLEANUP_INTERVAL", "86400")
+    # keep fetched jobs registered for the whole run so registry growth is visible;
+    # the timed cleanup pass below expires them
+    os.environ.setdefault("DOWNLOAD_KEEP_SECONDS", "86400")
+    os.environ.setdefault("PROXY_HOPS", "1")  # each simulated client sends its own X-Forwarded-For
+    os.environ.setdefault("MAX_QUEUED_PER_CLIENT", str(max(5, args.jobs)))
+    os.environ.setdefault("MAX_QUEUED", str(max(100, args.clients * args.jobs)))
+    if args.max_concurrent:
+        os.environ["MAX_CONCURRENT"] = str(args.max_concurrent)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as A
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *a, **kw):
+            pass
+
+    FakeYoutubeDL.size = args.size
+    FakeYoutubeDL.bandwidth = args.bandwidth
+    FakeYoutubeDL.extract_delay = args.extract_delay
+    A.YoutubeDL = FakeYoutubeDL
+
+    server = make_server("127.0.0.1", 0, A.app, threaded=True, request_handler=QuietHandler)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rec = Recorder()
+    lock = threading.Lock()
+    issued = [0]
+
+    def next_id():
+        with lock:
+            issued[0] += 1
+            return issued[0]
+
+    jobs_before, rss_before = len(A.JOBS), rss_kb()
+    jobs_peak, done = [jobs_before], threading.Event()
+
+    def sample_jobs():
+        while not done.wait(0.05):
+            jobs_peak[0] = max(jobs_peak[0], len(A.JOBS))
+
+    sampler = threading.Thread(target=sample_jobs, daemon=True)
+    sampler.start()
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(port, i, args, rec, next_id)) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    done.set()
+    sampler.join()
+    jobs_after, rss_after = len(A.JOBS), rss_kb()
+    jobs_peak[0] = max(jobs_peak[0], jobs_after)
+    disk_before_cleanup = temp_usage(A)
+
+    # expire everything that was fetched, however long the keep window was
+    A.DOWNLOAD_KEEP_SECONDS = A.RESUME_KEEP_SECONDS = 0
+    t_clean = time.perf_counter()
+    removed = A.cleanup_once()
+    A.EXPIRY.pool.shutdown(wait=True)  # directory deletes run in the cleanup pool
+    cleanup_seconds = time.perf_counter() - t_clean
+
+    endpoints = {}
+    for name, lat in sorted(rec.latency.items()):
+        endpoints[name] = {
+            "requests": len(lat),
+            "rps": round(len(lat) / wall, 2),
+            "p50_ms": round(percentile(lat, 50) * 1000, 2),
+            "p99_ms": round(percentile(lat, 99) * 1000, 2),
+            "max_ms": round(max(lat) * 1000, 2),
+            "status": {str(k): v for k, v in sorted(rec.status[name].items())},
+        }
+    total_requests = sum(len(v) for v in rec.latency.values())
+    report = {
+        "config": vars(args),
+        "wall_seconds": round(wall, 3),
+        "requests": total_requests,
+        "rps": round(total_requests / wall, 2),
+        "endpoints": endpoints,
+        "jobs": {
+            "completed": len(rec.job_seconds),
+            "failed": len(rec.failures),
+            "failures": sorted(set(rec.failures))[:10],
+            "p50_s": percentile(rec.job_seconds, 50),
+            "p99_s": percentile(rec.job_seconds, 99),
+            "fetched_bytes": rec.fetched_bytes,
+        },
+        "memory": {
+            "jobs_registered_before": jobs_before,
+            "jobs_registered_peak": jobs_peak[0],
+            "jobs_registered_after": jobs_after,
+            "jobs_registered_after_cleanup": len(A.JOBS),
+            "rss_kb_before": rss_before,
+            "rss_kb_after": rss_after,
+        },
+        "disk": {
+            "before_cleanup": disk_before_cleanup,
+            "after_cleanup": temp_usage(A),
+        },
+        "cleanup": {"removed": removed, "seconds": round(cleanup_seconds, 4)},
+        "caches": {
+            "info": {"hits": A.INFO_CACHE.hits, "misses": A.INFO_CACHE.misses,
+                     "coalesced": A.INFO_CACHE.coalesced},
+            "result": {"hits": A.ARTIFACTS.hits, "misses": A.ARTIFACTS.misses},
+        },
+    }
+    server.shutdown()
+    shutil.rmtree(work, ignore_errors=True)
+    out = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+    return report
+
+
+if __name__ == "__main__":
+    main()
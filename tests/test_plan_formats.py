@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+# keep the import offline: no yt-dlp prewarm, scratch dirs under a temp root
+_ROOT = tempfile.mkdtemp(prefix="hyper_test_")
+os.environ.setdefault("PREWARM", "0")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_ROOT, "jobs.db"))
+os.environ.setdefault("WORK_DIR", _ROOT)
+os.environ.setdefault("ARTIFACT_DIR", os.path.join(_ROOT, "artifacts"))
+
+import app  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture(scope="module")
+def recorded():
+    with open(os.path.join(FIXTURES, "youtube_formats.json")) as fh:
+        return json.load(fh)
+
+
+def test_1080p_stream_copies_mp4_and_m4a(recorded):
+    plan = app.plan_formats(recorded["formats"], "video", 1080, recorded["duration"])
+    assert plan["kind"] == "merge_copy"
+    assert plan["format"] == "137+140"
+    assert plan["height"] == 1080
+
+
+def test_360p_prefers_progressive(recorded):
+    plan = app.plan_formats(recorded["formats"], "video", 360, recorded["duration"])
+    assert plan["kind"] == "progressive"
+    assert plan["format"] == "18"
+
+
+def test_without_ffmpeg_only_progressive(recorded):
+    plan = app.plan_formats(recorded["formats"], "video", 1080, recorded["duration"], has_ffmpeg=False)
+    assert plan["kind"] == "progressive"
+    assert plan["format"] == "18"
+
+
+def test_manifests_and_storyboards_are_skipped(recorded):
+    plan = app.plan_formats(recorded["formats"], "video", 2160, recorded["duration"])
+    assert not plan["format"].startswith(("hls-", "sb"))
+
+
+def test_audio_matches_target_codec(recorded):
+    assert app.plan_formats(recorded["formats"], "audio")["format"] == "140"
+    assert app.plan_formats(recorded["formats"], "audio_opus")["format"] == "251"
+
+
+def test_empty_list_falls_back():
+    assert app.plan_formats([], "video", 720) is None